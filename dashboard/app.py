@@ -1,32 +1,61 @@
 from pathlib import Path
+import gzip
 import os
-from time import perf_counter
+import threading
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter, sleep
 from functools import wraps
+from typing import Callable, Iterable, Iterator
 
+import orjson
 import plotly.express as px
+import plotly.graph_objects as go
 from flask import (
     Flask,
+    g,
     jsonify,
     request,
     send_from_directory,
     make_response,
     Response,
+    stream_with_context,
 )
 from pydantic import ValidationError, parse_obj_as
 
 # from dash import Dash, Input, Output, dcc, html
-from log_parsing.database_def import TableNames
-from log_parsing.parse_access_log import load_df_from_db
 from log_parsing.plot_functions import (
+    FilteredDataFrame,
     FilterModel,
+    aggregate_cache,
+    filtered_frame_cache,
     plot_functions,
 )
 from log_parsing.config import logger
+from log_parsing.dashboard_data import (
+    DashboardData,
+    load_dashboard_data,
+    refresh_dashboard_data,
+)
+from log_parsing.follow_log import FOLLOW_RETRY_INTERVAL_S, follow_log
+from log_parsing.plot_payload import compact_figure, dumps, plot_template
+from log_parsing.response_cache import ResponseCache, make_cache_key
 
 
 DIST = Path(__file__).parent / "dist"
 PUBLIC = Path(__file__).parent / "public"
 PLOT_COLOR_SCHEME = px.colors.qualitative.T10
+# Plots are computed concurrently; a plot running longer than the budget, or not
+# starting within it, is left out
+PLOT_WORKERS = min(len(plot_functions), os.cpu_count() or 1)
+PLOT_TIME_BUDGET_S = float(os.environ.get("PLOT_TIME_BUDGET_S", 10))
+PLOT_POLL_INTERVAL_S = 0.05
+COMPRESSED_MIMETYPES = {"application/json", "application/x-ndjson"}
+GZIP_LEVEL = 6
+# Seconds between checks for newly ingested data; 0 disables the checks
+REFRESH_INTERVAL_S = float(os.environ.get("REFRESH_INTERVAL_S", 60))
+# Ingest the live nginx log in the background; see `follow_log`
+FOLLOW_NGINX_LOG = os.environ.get("FOLLOW_NGINX_LOG", "").lower() in ("1", "true")
 
 
 app = Flask(__name__, static_folder=PUBLIC)
@@ -39,18 +68,62 @@ app.config.update(
 # app.debug = True
 # app.logger.setLevel(logging.DEBUG)
 
-df = load_df_from_db(TableNames.PAGES_LOG)
-date_start = df["time"].min()
-date_end = df["time"].max()
+# Replaced as a whole by `refresh_data`; read once per request, so that a request
+# uses the same data throughout
+dashboard_data = load_dashboard_data()
+response_cache = ResponseCache(max_size=256, ttl_seconds=3600)
+plot_executor = ThreadPoolExecutor(max_workers=PLOT_WORKERS, thread_name_prefix="plot")
+plot_template_json = dumps(plot_template())
+
+
+def refresh_data():
+    """Swap in the data ingested since the last refresh, if any"""
+    global dashboard_data
+    new_data = refresh_dashboard_data(dashboard_data)
+    if new_data is dashboard_data:
+        return
+    dashboard_data = new_data
+    # Responses are keyed by the data version, and the memoized frames by the old
+    # frame, which they keep in memory, so the old entries are never used again
+    response_cache.clear()
+    filtered_frame_cache.clear()
+    aggregate_cache.clear()
+    logger.info(
+        f"Dashboard data refreshed: {len(new_data.df)} rollup rows "
+        f"up to {new_data.date_end}"
+    )
+
+
+def refresh_data_periodically(interval_s: float):
+    while True:
+        sleep(interval_s)
+        try:
+            refresh_data()
+        except Exception as e:
+            logger.exception(f"Refreshing the dashboard data failed: {e}")
+
+
+if REFRESH_INTERVAL_S > 0:
+    threading.Thread(
+        target=refresh_data_periodically,
+        args=(REFRESH_INTERVAL_S,),
+        name="refresh-data",
+        daemon=True,
+    ).start()
 
 
-filter_json = {
-    "minDate": date_start.strftime("%Y-%m-%d"),
-    "maxDate": date_end.strftime("%Y-%m-%d"),
-    "countries": df["country"].unique().sort().to_list(),
-    "continents": df["continent"].unique().sort().to_list(),
-    "pageNames": df["page_name"].unique().sort().to_list(),
-}
+def follow_nginx_log():
+    # `follow_log` retries failed batches itself; this restarts it if it fails to start
+    while True:
+        try:
+            follow_log()
+        except Exception as e:
+            logger.exception(f"Following the nginx log failed: {e}")
+        sleep(FOLLOW_RETRY_INTERVAL_S)
+
+
+if FOLLOW_NGINX_LOG:
+    threading.Thread(target=follow_nginx_log, name="follow-log", daemon=True).start()
 
 
 def route_with_time_taken(rule, methods=None):
@@ -64,9 +137,15 @@ def route_with_time_taken(rule, methods=None):
             result = func(*args, **kwargs)
             remote_addr = request.remote_addr
             time_taken_ms = (perf_counter() - time_before) * 1000
-            logger.info(
-                f"request {rule} from {remote_addr} took {time_taken_ms:.2f} ms"
-            )
+            message = f"request {rule} from {remote_addr} took {time_taken_ms:.2f} ms"
+            plot_times_ms = g.get("plot_times_ms")
+            if plot_times_ms:
+                plot_times = ", ".join(
+                    f"{plot_id}: {plot_time:.2f} ms"
+                    for plot_id, plot_time in plot_times_ms.items()
+                )
+                message += f" ({plot_times})"
+            logger.info(message)
             return result
 
         app.add_url_rule(rule, func.__name__, wrapper, methods=methods)
@@ -84,7 +163,18 @@ def all_plot_ids():
 @app.route("/filter-options", methods=["GET"])
 def return_filter_json():
     print("Sending filter options")
-    return jsonify(filter_json)
+    return jsonify(dashboard_data.filter_json)
+
+
+@app.route("/cache-stats", methods=["GET"])
+def return_cache_stats():
+    return jsonify(
+        {
+            "responses": response_cache.stats(),
+            "filtered_frames": filtered_frame_cache.stats(),
+            "aggregates": aggregate_cache.stats(),
+        }
+    )
 
 
 @app.route("/colors", methods=["GET"])
@@ -92,47 +182,361 @@ def return_colors():
     return jsonify(PLOT_COLOR_SCHEME)
 
 
-# @app.route("/filter-data/", methods=["GET", "POST"])
-@route_with_time_taken("/filter-data/", methods=["GET", "POST"])
-def parse_filters():
+def filter_data_frames(
+    data: DashboardData, filter_list: list[FilterModel]
+) -> tuple[list[int], list[FilteredDataFrame]]:
+    """The number of pages of each filter, and the filtered frames that aren't empty"""
+    filtered_dfs = [
+        filter.to_filtered_data_frame(data.df, colors=PLOT_COLOR_SCHEME)
+        for filter in filter_list
+    ]
+    filter_lengths = [df.num_pages for df in filtered_dfs]
+    filtered_dfs = [df for df in filtered_dfs if df.num_pages > 0]
+    return filter_lengths, filtered_dfs
+
+
+def empty_filters_response() -> Response:
+    logger.info("All filters are empty")
+    response = make_response(
+        jsonify(
+            {
+                "success": False,
+                "message": "All filters are empty",
+                "error_code": "EMPTY_FILTERS",
+            }
+        ),
+        400,
+    )
+    return response
+
+
+def use_compact_payload() -> bool:
+    """Whether the request asks for plots encoded by `compact_figure`"""
+    return request.args.get("compact") == "1"
+
+
+def compute_plot(
+    plot_function: Callable[[list[FilteredDataFrame]], go.Figure],
+    filtered_dfs: list[FilteredDataFrame],
+    compact: bool = False,
+) -> tuple[str | dict, float]:
+    """
+    The plot as JSON string, or as dict encoded by `compact_figure` if `compact`,
+    and the time it took in ms
+    """
+    time_before = perf_counter()
+    fig = plot_function(filtered_dfs)
+    plot = compact_figure(fig) if compact else fig.to_json()
+    return plot, (perf_counter() - time_before) * 1000
+
+
+class PlotJobs:
+    """
+    The plots computed for one request on `plot_executor`, with the time each one
+    started running, so time spent queued behind other requests doesn't count against
+    its budget
+    """
+
+    def __init__(
+        self, filtered_dfs: list[FilteredDataFrame], compact: bool = False
+    ) -> None:
+        self.submit_time = perf_counter()
+        self.start_times: dict[str, float] = {}
+        self.futures = {
+            plot_executor.submit(
+                self.run, plot_id, plot_function, filtered_dfs, compact
+            ): plot_id
+            for plot_id, plot_function in plot_functions.items()
+        }
+
+    def run(
+        self,
+        plot_id: str,
+        plot_function: Callable[[list[FilteredDataFrame]], go.Figure],
+        filtered_dfs: list[FilteredDataFrame],
+        compact: bool,
+    ) -> tuple[str | dict, float]:
+        self.start_times[plot_id] = perf_counter()
+        return compute_plot(plot_function, filtered_dfs, compact)
+
+    def is_overdue(self, plot_id: str, now: float) -> bool:
+        """
+        Whether the plot ran longer than `PLOT_TIME_BUDGET_S`, or did not start within
+        `PLOT_TIME_BUDGET_S` of being submitted
+        """
+        return (
+            now - self.start_times.get(plot_id, self.submit_time) > PLOT_TIME_BUDGET_S
+        )
+
+    def completed(self) -> Iterator[tuple[str, str | dict, float]]:
+        """
+        Yield the id, plot and time in ms of the plots as they complete. Plots that go
+        over their budget are cancelled and left out, as are the remaining plots when
+        the caller stops iterating early.
+        """
+        pending = set(self.futures)
+        try:
+            while len(pending) > 0:
+                done, pending = wait(
+                    pending, timeout=PLOT_POLL_INTERVAL_S, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    plot, time_ms = future.result()
+                    yield self.futures[future], plot, time_ms
+                now = perf_counter()
+                for future in [
+                    f for f in pending if self.is_overdue(self.futures[f], now)
+                ]:
+                    plot_id = self.futures[future]
+                    # A running plot can't be stopped; its result is dropped
+                    future.cancel()
+                    pending.remove(future)
+                    logger.warning(
+                        f"Plot {plot_id} went over its budget of "
+                        f"{PLOT_TIME_BUDGET_S} s; skipping"
+                    )
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def json_response(data: dict, compact: bool = False) -> Response:
+    if compact:
+        return Response(dumps(data), mimetype="application/json")
+    return jsonify(data)
+
+
+def make_plots_response(
+    data: DashboardData, filter_list: list[FilterModel], compact: bool
+) -> Response:
+    filter_lengths, filtered_dfs = filter_data_frames(data, filter_list)
+    if len(filtered_dfs) == 0:
+        return empty_filters_response()
+
+    plots = {}
+    plot_times_ms = {}
+    for plot_id, plot, time_ms in PlotJobs(filtered_dfs, compact).completed():
+        plots[plot_id] = plot
+        plot_times_ms[plot_id] = time_ms
+    # In the order of `plot_functions`, whichever plot finished first
+    plots = {plot_id: plots[plot_id] for plot_id in plot_functions if plot_id in plots}
+    g.plot_times_ms = {plot_id: plot_times_ms[plot_id] for plot_id in plots}
+
+    return_data = json_response({"plots": plots, "filters": filter_lengths}, compact)
+    if len(plots) < len(plot_functions):
+        # Don't cache incomplete responses
+        return_data.cache_control.no_store = True
+
+    return return_data
+
+
+def parse_request_filters() -> list[FilterModel] | None:
     request_json = request.get_json()
     try:
-        filter_list = parse_obj_as(list[FilterModel], request_json)
+        return parse_obj_as(list[FilterModel], request_json)
     except ValidationError:
         print("Invalid filter")
         print(request_json)
+        return None
+
+
+def filters_cache_key(
+    data: DashboardData, filter_list: list[FilterModel], *parts: str
+) -> str:
+    return make_cache_key(
+        data.version,
+        [filter.normalized() for filter in filter_list],
+        use_compact_payload(),
+        *parts,
+    )
+
+
+def not_modified_response(cache_key: str) -> Response | None:
+    """A 304 response if the client has the response with this key"""
+    if not request.if_none_match.contains_weak(cache_key):
+        return None
+    response = Response(status=304)
+    response.set_etag(cache_key)
+    return response
+
+
+def cached_response(
+    cache_key: str, make_json_response: Callable[[], Response]
+) -> Response:
+    """
+    Response from the response cache if possible, or else made by
+    `make_json_response` and cached if successful. Its ETag is `cache_key`.
+    """
+    not_modified = not_modified_response(cache_key)
+    if not_modified is not None:
+        return not_modified
+
+    response_data = response_cache.get(cache_key)
+    if response_data is None:
+        response = make_json_response()
+        if response.status_code != 200 or response.cache_control.no_store:
+            return response
+        response_data = response.get_data()
+        response_cache.put(cache_key, response_data)
+    else:
+        logger.info(
+            f"Response cache hit ({response_cache.hits} hits, "
+            f"{response_cache.misses} misses)"
+        )
+
+    response = Response(response_data, mimetype="application/json")
+    response.set_etag(cache_key)
+    return response
+
+
+# @app.route("/filter-data/", methods=["GET", "POST"])
+@route_with_time_taken("/filter-data/", methods=["GET", "POST"])
+def parse_filters():
+    filter_list = parse_request_filters()
+    if filter_list is None:
         return jsonify({"success": False})
-    filtered_dfs = [
-        filter.to_filtered_data_frame(df, colors=PLOT_COLOR_SCHEME)
-        for filter in filter_list
-    ]
-    filter_lengths = [len(df.dataframe) for df in filtered_dfs]
-    filtered_dfs = [df for df in filtered_dfs if len(df.dataframe) > 0]
-    if len(filtered_dfs) == 0:
-        logger.info("All filters are empty")
-        response = make_response(
-            jsonify(
-                {
-                    "success": False,
-                    "message": "All filters are empty",
-                    "error_code": "EMPTY_FILTERS",
-                }
-            ),
-            400,
+
+    compact = use_compact_payload()
+    data = dashboard_data
+    return cached_response(
+        filters_cache_key(data, filter_list),
+        lambda: make_plots_response(data, filter_list, compact),
+    )
+
+
+@route_with_time_taken("/plot/<plot_id>", methods=["GET", "POST"])
+def single_plot(plot_id: str):
+    """A single plot, as {"plot": ..., "filters": ...}"""
+    if plot_id not in plot_functions:
+        return make_response(jsonify({"success": False}), 404)
+    filter_list = parse_request_filters()
+    if filter_list is None:
+        return jsonify({"success": False})
+    compact = use_compact_payload()
+    data = dashboard_data
+
+    def make_plot_response() -> Response:
+        filter_lengths, filtered_dfs = filter_data_frames(data, filter_list)
+        if len(filtered_dfs) == 0:
+            return empty_filters_response()
+        plot, plot_time_ms = compute_plot(
+            plot_functions[plot_id], filtered_dfs, compact
         )
-        return response
+        g.plot_times_ms = {plot_id: plot_time_ms}
+        return json_response({"plot": plot, "filters": filter_lengths}, compact)
 
-    return_data = jsonify(
-        {
-            "plots": {
-                plot_id: plot_function(filtered_dfs).to_json()
-                for plot_id, plot_function in plot_functions.items()
-            },
-            "filters": filter_lengths,
-        }
+    return cached_response(
+        filters_cache_key(data, filter_list, plot_id), make_plot_response
     )
 
-    return return_data
+
+def ndjson_line(data: dict) -> bytes:
+    return dumps(data) + b"\n"
+
+
+@route_with_time_taken("/filter-data/stream", methods=["GET", "POST"])
+def stream_filters():
+    """
+    The response of `/filter-data/` as newline delimited JSON: first a line
+    {"filters": ...}, then a line {"plotId": ..., "plot": ...} for each plot as soon
+    as it is ready.
+    """
+    filter_list = parse_request_filters()
+    if filter_list is None:
+        return jsonify({"success": False})
+    compact = use_compact_payload()
+    data = dashboard_data
+    cache_key = filters_cache_key(data, filter_list)
+    not_modified = not_modified_response(cache_key)
+    if not_modified is not None:
+        return not_modified
+
+    cached_data = response_cache.get(cache_key)
+    if cached_data is not None:
+        data = orjson.loads(cached_data)
+        lines = [ndjson_line({"filters": data["filters"]})]
+        for plot_id, plot in data["plots"].items():
+            lines.append(ndjson_line({"plotId": plot_id, "plot": plot}))
+        # As one body, so it has a length and is compressed by `compress_response`
+        response = Response(b"".join(lines), mimetype="application/x-ndjson")
+        response.set_etag(cache_key)
+        return response
+
+    filter_lengths, filtered_dfs = filter_data_frames(data, filter_list)
+    if len(filtered_dfs) == 0:
+        return empty_filters_response()
+    plot_jobs = PlotJobs(filtered_dfs, compact)
+
+    def generate_lines():
+        yield ndjson_line({"filters": filter_lengths})
+        plots = {}
+        plot_times_ms = {}
+        for plot_id, plot, time_ms in plot_jobs.completed():
+            plots[plot_id] = plot
+            plot_times_ms[plot_id] = time_ms
+            yield ndjson_line({"plotId": plot_id, "plot": plot})
+        if len(plots) < len(plot_functions):
+            logger.warning(f"Streamed {len(plots)} of {len(plot_functions)} plots")
+        logger.info(f"Streamed plots: {plot_times_ms}")
+
+        if len(plots) == len(plot_functions):
+            # Same response as `/filter-data/`, in the order of `plot_functions`
+            plots = {plot_id: plots[plot_id] for plot_id in plot_functions}
+            response = json_response(
+                {"plots": plots, "filters": filter_lengths}, compact
+            )
+            response_cache.put(cache_key, response.get_data())
+
+    response = Response(
+        stream_with_context(generate_lines()), mimetype="application/x-ndjson"
+    )
+    response.set_etag(cache_key)
+    return response
+
+
+@app.route("/plot-template", methods=["GET"])
+def return_plot_template():
+    """The layout template of the plots, left out of compact plots"""
+    response = Response(plot_template_json, mimetype="application/json")
+    response.set_etag(make_cache_key(plot_template_json.decode()))
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 3600
+    return response.make_conditional(request)
+
+
+def gzip_chunks(chunks: Iterable[bytes | str]) -> Iterator[bytes]:
+    """Gzip a streamed response, flushing after every chunk"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    if (
+        "gzip" not in request.accept_encodings
+        or response.status_code != 200
+        or response.mimetype not in COMPRESSED_MIMETYPES
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    if response.is_streamed:
+        response.response = gzip_chunks(response.response)
+        response.headers.pop("Content-Length", None)
+    elif response.content_length is not None and response.content_length >= 1024:
+        response.set_data(gzip.compress(response.get_data(), GZIP_LEVEL))
+    else:
+        return response
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    # The compressed body differs from the uncompressed one with the same ETag
+    etag, _ = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
 
 
 @app.route("/")
@@ -1,6 +1,6 @@
 import "./bootstrap-loader"
 // import "./filter.css"
-import React, { useState, useEffect } from "react"
+import React, { useState, useEffect, useRef } from "react"
 import { createRoot } from "react-dom/client"
 import FilterContainerComponent from "./filterContainer"
 import PlotlyGraph from "./plotlyGraph"
@@ -18,34 +18,104 @@ interface PlotlyData {
     config: any
 }
 
-interface FilterDataResponse {
-    plots: {
-        [key: string]: string
+// Lines of the newline delimited JSON response of /filter-data/stream?compact=1
+type FilterDataLine = { filters: number[] } | { plotId: string; plot: PlotlyData }
+
+const TYPED_ARRAYS: Record<
+    string,
+    Float32ArrayConstructor | Int32ArrayConstructor | Float64ArrayConstructor
+> = {
+    f4: Float32Array,
+    i4: Int32Array,
+    f8: Float64Array,
+}
+
+// Compact plots contain numeric arrays as {dtype, bdata}, with bdata base64 encoded
+const decodeTypedArrays = (value: any): any => {
+    if (Array.isArray(value)) {
+        return value.map(decodeTypedArrays)
+    }
+    if (value === null || typeof value !== "object") {
+        return value
+    }
+    if (value.dtype in TYPED_ARRAYS && typeof value.bdata === "string") {
+        const bytes = Uint8Array.from(atob(value.bdata), (char) => char.charCodeAt(0))
+        return new TYPED_ARRAYS[value.dtype](bytes.buffer)
+    }
+    return Object.fromEntries(
+        Object.entries(value).map(([key, item]) => [key, decodeTypedArrays(item)])
+    )
+}
+
+// The layout template is the same for all plots, so compact plots leave it out
+const plotTemplate: Promise<any> = fetch("/plot-template").then((response) =>
+    response.json()
+)
+
+const readJsonLines = async (
+    response: Response,
+    onLine: (line: any) => void
+): Promise<void> => {
+    const reader = response.body!.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ""
+    while (true) {
+        const { done, value } = await reader.read()
+        if (done) {
+            break
+        }
+        buffer += decoder.decode(value, { stream: true })
+        const lines = buffer.split("\n")
+        buffer = lines.pop()!
+        lines
+            .filter((line) => line.length > 0)
+            .forEach((line) => onLine(JSON.parse(line)))
+    }
+    if (buffer.length > 0) {
+        onLine(JSON.parse(buffer))
     }
-    filters: number[]
 }
 
 const App = () => {
     const [plotIds, setPlotIds] = useState<string[]>([])
     const [plotsData, setPlotsData] = useState<{ [key: string]: PlotlyData }>({})
     const [filterLengths, setFilterLengths] = useState<number[]>([])
+    // ETag of the plots currently shown; the server answers 304 if they are unchanged
+    const plotsEtag = useRef<string | null>(null)
+    const latestRequest = useRef(0)
+    const plotIdsRef = useRef<string[]>([])
+    const [pendingPlots, setPendingPlots] = useState<Set<string>>(new Set())
 
     useEffect(() => {
         fetch("/all-plots/")
             .then((response) => response.json())
-            .then((ids) => setPlotIds(ids))
+            .then((ids) => {
+                plotIdsRef.current = ids
+                setPlotIds(ids)
+            })
             .catch((err) => console.error(err))
     }, [])
 
     const updatePlots = (filters: any) => {
-        fetch("/filter-data/", {
-            method: "POST",
-            body: JSON.stringify(filters),
-            headers: {
-                "Content-Type": "application/json",
-            },
-        })
-            .then((response) => {
+        const requestNumber = ++latestRequest.current
+        const headers: Record<string, string> = {
+            "Content-Type": "application/json",
+        }
+        if (plotsEtag.current !== null) {
+            headers["If-None-Match"] = plotsEtag.current
+        }
+        Promise.all([
+            fetch("/filter-data/stream?compact=1", {
+                method: "POST",
+                body: JSON.stringify(filters),
+                headers: headers,
+            }),
+            plotTemplate,
+        ])
+            .then(([response, template]) => {
+                if (response.status === 304) {
+                    return
+                }
                 if (!response.ok) {
                     return response.json().then((errorData) => {
                         if (errorData.error_code === "EMPTY_FILTERS") {
@@ -55,23 +125,38 @@ const App = () => {
                         }
                     })
                 }
-                return response.json() as Promise<FilterDataResponse>
-            })
-            .then((response: FilterDataResponse) => {
-                const parsedData = Object.entries(response.plots).reduce<
-                    Record<string, PlotlyData>
-                >(
-                    (
-                        acc: Record<string, any>,
-                        [plotId, jsonString]: [string, string]
-                    ) => {
-                        acc[plotId] = JSON.parse(jsonString) as PlotlyData
-                        return acc
-                    },
-                    {}
-                )
-                setPlotsData(parsedData)
-                setFilterLengths(response.filters)
+                const etag = response.headers.get("ETag")
+                const receivedPlots = new Set<string>()
+                setPendingPlots(new Set(plotIdsRef.current))
+                // Show each plot as soon as it arrives, unless the filters changed
+                return readJsonLines(response, (line: FilterDataLine) => {
+                    if (requestNumber !== latestRequest.current) {
+                        return
+                    }
+                    if ("filters" in line) {
+                        setFilterLengths(line.filters)
+                        return
+                    }
+                    receivedPlots.add(line.plotId)
+                    const plotData = decodeTypedArrays(line.plot) as PlotlyData
+                    plotData.layout.template = template
+                    setPlotsData((plots) => ({ ...plots, [line.plotId]: plotData }))
+                    setPendingPlots((pending) => {
+                        const stillPending = new Set(pending)
+                        stillPending.delete(line.plotId)
+                        return stillPending
+                    })
+                }).then(() => {
+                    // Only remember the ETag of a complete set of plots, so the next
+                    // update is not answered with 304 while some plots are missing
+                    if (requestNumber === latestRequest.current) {
+                        const complete = plotIdsRef.current.every((id) =>
+                            receivedPlots.has(id)
+                        )
+                        plotsEtag.current = complete ? etag : null
+                        setPendingPlots(new Set())
+                    }
+                })
             })
             .catch((err) => {
                 if (err instanceof EmptyFilterError) {
@@ -107,6 +192,7 @@ const App = () => {
                                 data={plotsData[id]?.data || []}
                                 layout={plotsData[id]?.layout || {}}
                                 config={plotsData[id]?.config || {}}
+                                loading={pendingPlots.has(id)}
                             />
                         </div>
                     ))}
@@ -6,9 +6,17 @@ interface PlotlyGraphProps {
     data: any
     layout: any
     config: any
+    // True while a newer version of the plot is being computed
+    loading?: boolean
 }
 
-const PlotlyGraph: React.FC<PlotlyGraphProps> = ({ id, data, layout, config }) => {
+const PlotlyGraph: React.FC<PlotlyGraphProps> = ({
+    id,
+    data,
+    layout,
+    config,
+    loading = false,
+}) => {
     const containerRef = useRef<HTMLDivElement>(null)
     const plotRef = useRef<Plot>(null)
 
@@ -28,7 +36,11 @@ const PlotlyGraph: React.FC<PlotlyGraphProps> = ({ id, data, layout, config }) =
 
 
     return (
-        <div ref={containerRef}>
+        <div
+            ref={containerRef}
+            style={{ opacity: loading ? 0.5 : 1, transition: "opacity 0.2s" }}
+            aria-busy={loading}
+        >
             <h3>{id}</h3>
             <Plot
                 ref={plotRef}
@@ -0,0 +1,70 @@
+# %%
+"""
+Benchmark the `FilteredDataFrame` filters against the regex predicate they replaced:
+`str.contains` on the strings joined with "|", and `is_between` on the time column.
+"""
+
+import datetime
+from time import perf_counter
+from typing import Any
+
+import polars as pl
+
+from log_parsing.plot_functions import FilteredDataFrame, load_pages_df
+
+df = load_pages_df()
+df_strings = df.with_columns(
+    [pl.col(column).cast(pl.Utf8) for column in ["country", "continent", "page_name"]]
+)
+date_end = df["time"].max()
+assert isinstance(date_end, datetime.datetime)
+date_start = date_end - datetime.timedelta(days=30)
+
+filters: dict[str, dict[str, Any]] = {
+    "all": {},
+    "last month": dict(date_start=date_start, date_end=date_end),
+    "countries": dict(countries=["Netherlands", "Germany", "United States"]),
+    "last month, home page in Europe": dict(
+        date_start=date_start,
+        date_end=date_end,
+        continents=["Europe"],
+        page_names=["home"],
+    ),
+}
+
+
+def regex_filter(
+    df: pl.DataFrame,
+    date_start: datetime.datetime | None = None,
+    date_end: datetime.datetime | None = None,
+    countries: list[str] | None = None,
+    continents: list[str] | None = None,
+    page_names: list[str] | None = None,
+) -> pl.DataFrame:
+    predicate = pl.lit(True)
+    if date_start is not None and date_end is not None:
+        predicate &= pl.col("time").is_between(date_start, date_end)
+    for column, values in [
+        ("country", countries),
+        ("continent", continents),
+        ("page_name", page_names),
+    ]:
+        if values is not None:
+            predicate &= pl.col(column).str.contains("|".join(values))
+    return df.filter(predicate)
+
+
+def time_filter(filter_function, num_repeats: int = 20) -> float:
+    time_before = perf_counter()
+    for _ in range(num_repeats):
+        filter_function()
+    return (perf_counter() - time_before) * 1000 / num_repeats
+
+
+# %%
+for name, kwargs in filters.items():
+    regex_ms = time_filter(lambda: regex_filter(df_strings, **kwargs))
+    # `_filter_df` directly, since `dataframe` is memoized in `filtered_frame_cache`
+    filtered_df = FilteredDataFrame(df, **kwargs)
+    is_in_ms = time_filter(lambda: filtered_df._filter_df(df))
+    print(f"{name:>32}: {regex_ms:8.2f} ms regex, {is_in_ms:8.2f} ms is_in")
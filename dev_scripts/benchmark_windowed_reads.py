@@ -0,0 +1,72 @@
+# %%
+"""
+Benchmark windowed reads of `access_log` and `pages_log` with and without the
+secondary indexes, on a copy of the database.
+"""
+
+import datetime
+import shutil
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import Select, func, select
+
+from log_parsing.database_def import (
+    SQLITE_DB_PATH,
+    TableNames,
+    create_engine_table,
+    read_sql_select,
+)
+
+tmp_dir = Path(tempfile.mkdtemp())
+db_path = tmp_dir / SQLITE_DB_PATH.name
+shutil.copy(SQLITE_DB_PATH, db_path)
+engine, tables = create_engine_table(db_path)
+access_log = tables[TableNames.ACCESS_LOG]
+pages_log = tables[TableNames.PAGES_LOG]
+
+max_time = read_sql_select(select(func.max(pages_log.c.time).label("t")), db_path)
+window_start = datetime.datetime.fromisoformat(str(max_time["t"][0]))
+window_start -= datetime.timedelta(days=7)
+
+queries: dict[str, Select] = {
+    "access_log last week": select(access_log).where(
+        access_log.c.time_iso8601 >= window_start
+    ),
+    "pages_log last week": select(pages_log).where(pages_log.c.time >= window_start),
+    "pages_log page last week": select(pages_log).where(
+        pages_log.c.page_name == "home", pages_log.c.time >= window_start
+    ),
+    "pages_log country last week": select(pages_log).where(
+        pages_log.c.country == "Netherlands", pages_log.c.time >= window_start
+    ),
+}
+
+
+def time_queries(num_repeats: int = 5) -> dict[str, float]:
+    timings = {}
+    for name, query in queries.items():
+        time_before = perf_counter()
+        for _ in range(num_repeats):
+            read_sql_select(query, db_path)
+        timings[name] = (perf_counter() - time_before) * 1000 / num_repeats
+    return timings
+
+
+# %%
+with_indexes = time_queries()
+with engine.connect() as conn:
+    for table in tables.values():
+        for index in table.indexes:
+            index.drop(conn)
+    conn.commit()
+without_indexes = time_queries()
+engine.dispose()
+shutil.rmtree(tmp_dir)
+
+for name in queries:
+    print(
+        f"{name:>28}: {without_indexes[name]:8.2f} ms without indexes, "
+        f"{with_indexes[name]:8.2f} ms with indexes"
+    )
@@ -0,0 +1,32 @@
+# %%
+"""
+Check the columnar parsing of `time_iso8601` against `parse_nginx_time`, on a chunk
+spanning the change to daylight saving time, so its lines have different offsets.
+"""
+
+import datetime
+import json
+
+from log_parsing.parse_access_log import parse_access_chunk
+from log_parsing.timestamps import parse_nginx_time
+
+times = [
+    "2023-03-26T01:59:59+01:00",
+    "2023-03-26T03:00:00+02:00",
+    "2023-10-29T02:59:59+02:00",
+    "2023-10-29T02:00:00+01:00",
+    "2023-03-26T03:00:00-05:30",
+]
+lines = [
+    json.dumps({"time_iso8601": time, "request_id": str(i)}) + "\n"
+    for i, time in enumerate(times)
+]
+chunk_df = parse_access_chunk(lines, {"time_iso8601", "request_id"})
+
+for time, time_utc, time_local in zip(
+    times, chunk_df["time_utc"], chunk_df["time_iso8601"]
+):
+    expected = parse_nginx_time(time)
+    assert time_utc == expected.astimezone(datetime.timezone.utc), time
+    assert time_local == expected.replace(tzinfo=None), time
+print(f"Parsed {len(times)} timestamps with mixed offsets like parse_nginx_time")
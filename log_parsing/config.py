@@ -24,6 +24,11 @@ except KeyError:
 
 DATA_PATH = PROJECT_ROOT / "data"
 LOGS_PATH = PROJECT_ROOT / "logs"
+# The live access log written by nginx, followed by `follow_log`
+NGINX_LOG_PATH = Path(
+    os.environ.get("NGINX_LOG_PATH", PROJECT_ROOT / "nginx_log" / "access.log")
+)
+USE_PARQUET_STORE = os.environ.get("USE_PARQUET_STORE", "").lower() in ("1", "true")
 LOGGER_NAME = "parser_logger"
 
 
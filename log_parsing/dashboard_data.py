@@ -0,0 +1,122 @@
+# %%
+"""
+The data shown by the dashboard: the rollup of the pages and the values derived from
+it. A `DashboardData` is not modified after it is made; `refresh_dashboard_data`
+makes a new one with the hours recounted since, which the dashboard swaps in.
+"""
+
+import datetime
+
+import polars as pl
+from sqlalchemy import func, select
+
+from log_parsing.config import logger
+from log_parsing.database_def import TableNames, create_engine_table
+from log_parsing.plot_functions import load_rollup_df
+from log_parsing.response_cache import make_cache_key
+
+# Keys of the filter options and the rollup columns they are taken from
+FILTER_OPTION_COLUMNS = {
+    "countries": "country",
+    "continents": "continent",
+    "pageNames": "page_name",
+}
+
+
+def unique_strings(column: pl.Series) -> list[str]:
+    return column.cast(pl.Utf8).unique().sort().to_list()
+
+
+class DashboardData:
+    def __init__(
+        self,
+        df: pl.DataFrame,
+        last_update_id: int,
+        filter_options: dict[str, list[str]] | None = None,
+    ):
+        self.df = df
+        self.last_update_id = last_update_id
+        date_start = df["time"].min()
+        date_end = df["time"].max()
+        if not isinstance(date_start, datetime.datetime) or not isinstance(
+            date_end, datetime.datetime
+        ):
+            raise ValueError("The pages rollup has no rows")
+        self.date_start = date_start
+        self.date_end = date_end
+        # Part of the cache keys and ETags, so responses for older data are not reused
+        self.version = make_cache_key(
+            last_update_id, len(df), df["count"].sum(), self.date_end
+        )
+        if filter_options is None:
+            filter_options = {
+                key: unique_strings(df[column])
+                for key, column in FILTER_OPTION_COLUMNS.items()
+            }
+        self.filter_options = filter_options
+
+    @property
+    def filter_json(self) -> dict:
+        return {
+            "minDate": self.date_start.strftime("%Y-%m-%d"),
+            "maxDate": self.date_end.strftime("%Y-%m-%d"),
+            **self.filter_options,
+        }
+
+
+def read_rollup_updates(
+    after_id: int,
+) -> list[tuple[int, datetime.datetime | None, datetime.datetime | None]]:
+    """The updates of `pages_rollup` with an id larger than `after_id`"""
+    engine, tables = create_engine_table()
+    rollup_updates = tables[TableNames.ROLLUP_UPDATES]
+    stmt = select(rollup_updates).where(rollup_updates.c.id > after_id)
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(stmt)]
+
+
+def load_dashboard_data() -> DashboardData:
+    engine, tables = create_engine_table()
+    rollup_updates = tables[TableNames.ROLLUP_UPDATES]
+    # Read before the rollup, so an update made while loading is applied next refresh
+    with engine.connect() as conn:
+        last_update_id = conn.execute(select(func.max(rollup_updates.c.id))).scalar()
+    return DashboardData(load_rollup_df(), last_update_id or 0)
+
+
+def refresh_dashboard_data(data: DashboardData) -> DashboardData:
+    """
+    Reload the hours of `data` recounted since it was loaded. Returns `data` itself
+    if nothing changed.
+    """
+    updates = read_rollup_updates(data.last_update_id)
+    if len(updates) == 0:
+        return data
+    last_update_id = max(update_id for update_id, _, _ in updates)
+    start_hours = [start_hour for _, start_hour, _ in updates]
+    end_hours = [end_hour for _, _, end_hour in updates]
+    if None in start_hours or None in end_hours:
+        logger.info("Rollup was rebuilt; reloading all dashboard data")
+        return DashboardData(load_rollup_df(), last_update_id)
+
+    start_hour = min(hour for hour in start_hours if hour is not None)
+    end_hour = max(hour for hour in end_hours if hour is not None)
+    new_df = load_rollup_df(start_hour, end_hour)
+    kept_df = data.df.filter(~pl.col("time").is_between(start_hour, end_hour))
+    df = pl.concat([kept_df, new_df]).sort("time")
+    filter_options = {
+        key: unique_strings(
+            pl.concat(
+                [
+                    pl.Series(data.filter_options[key], dtype=pl.Utf8),
+                    new_df[column].cast(pl.Utf8),
+                ]
+            )
+        )
+        for key, column in FILTER_OPTION_COLUMNS.items()
+    }
+    logger.info(
+        f"Refreshed dashboard data from {start_hour} to {end_hour}: "
+        f"{len(data.df) - len(kept_df)} rows replaced by {len(new_df)}"
+    )
+    return DashboardData(df, last_update_id, filter_options)
@@ -1,16 +1,23 @@
 # %%
+import os
+import threading
 from enum import Enum
+from pathlib import Path
 
+import polars as pl
 from sqlalchemy import (
     Column,
     DateTime,
     Engine,
     Float,
+    Index,
     Integer,
     MetaData,
+    Select,
     String,
     Table,
     create_engine,
+    event,
 )
 
 from log_parsing.config import DATA_PATH
@@ -19,14 +26,88 @@ from log_parsing.config import DATA_PATH
 class TableNames(Enum):
     ACCESS_LOG = "access_log"
     PAGES_LOG = "pages_log"
+    IP_GEO_CACHE = "ip_geo_cache"
+    PAGES_ROLLUP = "pages_rollup"
+    ROLLUP_UPDATES = "rollup_updates"
+    LOG_OFFSETS = "log_offsets"
+    INGEST_CHECKPOINTS = "ingest_checkpoints"
 
 
+TIME_COLUMNS = {
+    TableNames.ACCESS_LOG: "time_iso8601",
+    TableNames.PAGES_LOG: "time",
+    TableNames.PAGES_ROLLUP: "time",
+}
+
 SQLITE_DB_PATH = DATA_PATH / "access.db"
 
+# WAL is not used: `pl.read_sql` reads through connectorx, which bundles its own
+# copy of SQLite. Two copies in one process don't share their POSIX locks, which
+# corrupts a WAL database as soon as both have it open.
+SQLITE_PRAGMAS = {
+    "journal_mode": "DELETE",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative means KiB instead of pages
+    "temp_store": "MEMORY",
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def create_indexes(engine: Engine, metadata: MetaData):
+    """
+    Create the indexes of all tables that don't exist yet. `create_all` only
+    creates indexes together with their table, so this migrates databases made
+    before an index was added.
+    """
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+_storage_lock = threading.Lock()
+_storage: dict[Path, tuple[Engine, dict[TableNames, Table]]] = {}
+
+
+def create_engine_table(
+    db_path: Path | None = None,
+) -> tuple[Engine, dict[TableNames, Table]]:
+    """
+    Return the engine and tables of the database at `db_path`, by default
+    `SQLITE_DB_PATH`.
+
+    The engine is created and the schema is checked only on the first call for a
+    path in this process; later calls share the engine and its connection pool.
+    """
+    if db_path is None:
+        db_path = SQLITE_DB_PATH
+    with _storage_lock:
+        if db_path not in _storage:
+            _storage[db_path] = _create_engine_table(db_path)
+        return _storage[db_path]
+
 
-def create_engine_table() -> tuple[Engine, dict[TableNames, Table]]:
-    engine_url = "sqlite:///" + str(SQLITE_DB_PATH)
+def _reset_storage_after_fork():
+    """Make a forked process open its own connections to the databases."""
+    global _storage_lock
+    _storage_lock = threading.Lock()
+    for engine, _ in _storage.values():
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_storage_after_fork)
+
+
+def _create_engine_table(db_path: Path) -> tuple[Engine, dict[TableNames, Table]]:
+    engine_url = "sqlite:///" + str(db_path)
     engine = create_engine(engine_url)
+    event.listen(engine, "connect", set_sqlite_pragmas)
 
     metadata = MetaData()
     access_log = Table(
@@ -44,6 +125,7 @@ def create_engine_table() -> tuple[Engine, dict[TableNames, Table]]:
         Column("body_bytes_sent", Integer),
         Column("status", Integer),
         Column("time_iso8601", DateTime),
+        Index("ix_access_log_time_iso8601", "time_iso8601"),
     )
 
     pages_log = Table(
@@ -62,11 +144,94 @@ def create_engine_table() -> tuple[Engine, dict[TableNames, Table]]:
         Column("country_iso", String),
         Column("continent", String),
         Column("local_time", DateTime),
+        Index("ix_pages_log_time", "time"),
+        Index("ix_pages_log_page_name_time", "page_name", "time"),
+        Index("ix_pages_log_country_time", "country", "time"),
+    )
+
+    ip_geo_cache = Table(
+        TableNames.IP_GEO_CACHE.value,
+        metadata,
+        Column("addr", String, primary_key=True),
+        Column("timezone", String),
+        Column("country", String),
+        Column("country_iso", String),
+        Column("continent", String),
+        Column("mmdb_build", Integer),
+    )
+
+    # Number of pages per hour of `time` and combination of the other columns, with
+    # `local_minute` the minute of the day of `local_time` rounded down to 10 minutes
+    pages_rollup = Table(
+        TableNames.PAGES_ROLLUP.value,
+        metadata,
+        Column("time", DateTime),
+        Column("weekday", Integer),
+        Column("page_name", String),
+        Column("country", String),
+        Column("continent", String),
+        Column("local_minute", Integer),
+        Column("count", Integer),
+        Index("ix_pages_rollup_time", "time"),
+    )
+
+    # Hours recounted by each update of `pages_rollup`; NULL means unbounded
+    rollup_updates = Table(
+        TableNames.ROLLUP_UPDATES.value,
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("start_hour", DateTime),
+        Column("end_hour", DateTime),
+        sqlite_autoincrement=True,
+    )
+
+    # Byte offset up to which a followed log file was ingested, and its inode
+    log_offsets = Table(
+        TableNames.LOG_OFFSETS.value,
+        metadata,
+        Column("path", String, primary_key=True),
+        Column("inode", Integer),
+        Column("offset", Integer),
+    )
+
+    # Progress of the ingest of each log file, see `ingest_log_file`. The dates are
+    # ISO 8601 strings, to keep their UTC offset
+    ingest_checkpoints = Table(
+        TableNames.INGEST_CHECKPOINTS.value,
+        metadata,
+        Column("file_key", String, primary_key=True),
+        Column("file_name", String),
+        Column("inode", Integer),
+        Column("size", Integer),
+        Column("offset", Integer),
+        Column("start_date", String),
+        Column("end_date", String),
+        Column("status", String),
     )
 
     metadata.create_all(engine, checkfirst=True)
+    create_indexes(engine, metadata)
     tables = {
         TableNames.ACCESS_LOG: access_log,
         TableNames.PAGES_LOG: pages_log,
+        TableNames.IP_GEO_CACHE: ip_geo_cache,
+        TableNames.PAGES_ROLLUP: pages_rollup,
+        TableNames.ROLLUP_UPDATES: rollup_updates,
+        TableNames.LOG_OFFSETS: log_offsets,
+        TableNames.INGEST_CHECKPOINTS: ingest_checkpoints,
     }
     return engine, tables
+
+
+def read_sql_select(stmt: Select, db_path: Path | None = None) -> pl.DataFrame:
+    """
+    Run a SQLAlchemy select statement with `pl.read_sql`. The parameters are
+    rendered into the SQL text by SQLAlchemy, which quotes and formats them the
+    same way as when they are bound.
+    """
+    engine, _ = create_engine_table(db_path)
+    db_url = str(engine.url).replace("///", "//")
+    sql_stmt = stmt.compile(
+        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+    )
+    return pl.read_sql(str(sql_stmt), db_url)
@@ -0,0 +1,279 @@
+# %%
+"""
+Follow the live nginx access log and ingest the lines as they are written.
+
+New lines are ingested in batches of at most `batch_size` lines, at the latest
+`flush_interval_s` seconds after the first of them was read. After each batch the
+byte offset up to which the log is ingested is stored in `log_offsets`, so a
+restarted follower continues where it stopped. Lines ingested again after a crash
+in between are ignored, since their `request_id` is already in the database.
+
+Rotation (another file at the path) and truncation of the log are detected from the
+inode and size of the file; the rest of the old file is ingested before the new one.
+
+A batch that fails because the database is unavailable is retried, with the lines
+kept pending. A batch that fails for any other reason, such as a malformed line, is
+split up until the lines that can't be ingested are found; those are logged and
+skipped, so they don't hold up the lines after them.
+"""
+
+import argparse
+import os
+import threading
+from pathlib import Path
+from time import monotonic
+from typing import BinaryIO
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from log_parsing.config import NGINX_LOG_PATH, logger
+from log_parsing.database_def import TableNames, create_engine_table
+from log_parsing.parse_access_log import ingest_access_log, make_insert_pages
+
+FOLLOW_BATCH_SIZE = 10_000
+FOLLOW_FLUSH_INTERVAL_S = 5.0
+FOLLOW_POLL_INTERVAL_S = 0.5
+# Seconds to wait before retrying after a failure, doubled up to the maximum
+FOLLOW_RETRY_INTERVAL_S = 5.0
+FOLLOW_MAX_RETRY_INTERVAL_S = 300.0
+
+
+def read_log_offset(log_path: Path) -> tuple[int | None, int]:
+    """The inode and offset stored for the log; `(None, 0)` if there are none"""
+    engine, tables = create_engine_table()
+    log_offsets = tables[TableNames.LOG_OFFSETS]
+    stmt = select(log_offsets.c.inode, log_offsets.c.offset).where(
+        log_offsets.c.path == str(log_path)
+    )
+    with engine.connect() as conn:
+        row = conn.execute(stmt).first()
+    if row is None:
+        return None, 0
+    return row.inode, row.offset
+
+
+def write_log_offset(log_path: Path, inode: int | None, offset: int):
+    engine, tables = create_engine_table()
+    log_offsets = tables[TableNames.LOG_OFFSETS]
+    with engine.connect() as conn:
+        conn.execute(
+            log_offsets.insert().prefix_with("OR REPLACE"),
+            {"path": str(log_path), "inode": inode, "offset": offset},
+        )
+        conn.commit()
+
+
+def ingest_lines(lines: list[bytes]):
+    """Ingest complete lines of the access log and make their pages"""
+    start_date, end_date = ingest_access_log(
+        (line.decode() for line in lines), columnar=True
+    )
+    make_insert_pages(start_date, end_date)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether ingesting may succeed when retried, e.g. once the database is unlocked"""
+    return isinstance(error, OperationalError)
+
+
+def ingest_lines_skipping_bad(lines: list[bytes], log_path: Path) -> int:
+    """
+    Ingest the lines, halving the batch after a failure that is not transient until
+    the lines that can't be ingested are left; those are logged and skipped.
+    Transient failures are raised. Returns the number of lines skipped.
+    """
+    try:
+        ingest_lines(lines)
+        return 0
+    except Exception as e:
+        if is_transient(e):
+            raise
+        if len(lines) == 1:
+            logger.error(f"Skipping line of {log_path} that can't be ingested: {e}")
+            logger.error(f"Skipped line: {lines[0]!r}")
+            return 1
+    half = len(lines) // 2
+    num_skipped = ingest_lines_skipping_bad(lines[:half], log_path)
+    return num_skipped + ingest_lines_skipping_bad(lines[half:], log_path)
+
+
+class LogFollower:
+    """
+    Reads the complete lines appended to a log file, starting at byte `offset` of
+    the file with `inode`. `offset` is kept at the end of the last line read.
+    """
+
+    def __init__(self, log_path: Path, inode: int | None = None, offset: int = 0):
+        self.log_path = log_path
+        self.file: BinaryIO | None = None
+        self.inode = inode
+        self.offset = offset
+
+    def open(self) -> bool:
+        """
+        Open the log at `offset` if it is still the file with `inode`, or else at the
+        start. Returns False if the log doesn't exist.
+        """
+        try:
+            file = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(file.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            if self.offset > 0:
+                logger.warning(
+                    f"{self.log_path} was rotated or truncated after offset "
+                    f"{self.offset}; reading it from the start"
+                )
+            self.offset = 0
+        file.seek(self.offset)
+        self.file = file
+        self.inode = stat.st_ino
+        logger.info(f"Following {self.log_path} from offset {self.offset}")
+        return True
+
+    def open_replacement(self):
+        """Open the file that replaced the log, from the start"""
+        self.close()
+        self.inode = None
+        self.offset = 0
+        self.open()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_lines(self, max_lines: int) -> list[bytes]:
+        if self.file is None:
+            self.open()
+        file = self.file
+        if file is None:
+            return []
+        lines: list[bytes] = []
+        while len(lines) < max_lines:
+            line = file.readline()
+            if not line.endswith(b"\n"):
+                # End of the file, possibly in a line still being written
+                file.seek(self.offset)
+                break
+            lines.append(line)
+            self.offset += len(line)
+        return lines
+
+    def is_replaced(self) -> bool:
+        """Whether the log was rotated or truncated after the last line read"""
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            # Rotated, but not yet created again
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.offset
+
+
+def follow_log(
+    log_path: Path = NGINX_LOG_PATH,
+    batch_size: int = FOLLOW_BATCH_SIZE,
+    flush_interval_s: float = FOLLOW_FLUSH_INTERVAL_S,
+    poll_interval_s: float = FOLLOW_POLL_INTERVAL_S,
+    stop: threading.Event | None = None,
+):
+    """Ingest the lines appended to the log until `stop` is set"""
+    if stop is None:
+        stop = threading.Event()
+    follower = LogFollower(log_path, *read_log_offset(log_path))
+    pending: list[bytes] = []
+    first_pending_time = 0.0
+
+    retry_interval_s = FOLLOW_RETRY_INTERVAL_S
+
+    def flush():
+        # The offset is only stored, and the lines only dropped, after the ingest
+        try:
+            ingest_lines(pending)
+            num_skipped = 0
+        except Exception as e:
+            if is_transient(e):
+                raise
+            logger.warning(
+                f"Ingesting {len(pending)} lines failed: {e}; looking for the lines "
+                "that can't be ingested"
+            )
+            # Lines already ingested are ignored when the batch is ingested again
+            num_skipped = ingest_lines_skipping_bad(pending, log_path)
+        write_log_offset(log_path, follower.inode, follower.offset)
+        logger.info(
+            f"Ingested {len(pending) - num_skipped} lines up to offset "
+            f"{follower.offset}, skipping {num_skipped}"
+        )
+        pending.clear()
+
+    while not stop.is_set():
+        try:
+            lines = follower.read_lines(batch_size - len(pending))
+            if len(lines) > 0 and len(pending) == 0:
+                first_pending_time = monotonic()
+            pending.extend(lines)
+            if len(pending) > 0 and (
+                len(pending) >= batch_size
+                or monotonic() - first_pending_time >= flush_interval_s
+            ):
+                flush()
+            retry_interval_s = FOLLOW_RETRY_INTERVAL_S
+            if len(lines) > 0:
+                continue
+            if follower.file is not None and follower.is_replaced():
+                # The pending lines are from the old file, so ingest them first
+                if len(pending) > 0:
+                    flush()
+                follower.open_replacement()
+                continue
+        except Exception as e:
+            logger.exception(
+                f"Following {log_path} failed with {len(pending)} lines pending; "
+                f"retrying in {retry_interval_s} s: {e}"
+            )
+            stop.wait(retry_interval_s)
+            retry_interval_s = min(2 * retry_interval_s, FOLLOW_MAX_RETRY_INTERVAL_S)
+            continue
+        stop.wait(poll_interval_s)
+
+    if len(pending) > 0:
+        try:
+            flush()
+        except Exception as e:
+            logger.exception(
+                f"Ingesting the last {len(pending)} lines of {log_path} failed; "
+                f"they are read again on the next start: {e}"
+            )
+    follower.close()
+
+
+def parse_follow_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_path", type=Path, nargs="?", default=NGINX_LOG_PATH)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=FOLLOW_BATCH_SIZE,
+        help="Maximum number of lines ingested at once",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=FOLLOW_FLUSH_INTERVAL_S,
+        help="Maximum seconds between reading a line and ingesting it",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=FOLLOW_POLL_INTERVAL_S,
+        help="Seconds between checks for new lines",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_follow_args()
+    follow_log(args.log_path, args.batch_size, args.flush_interval, args.poll_interval)
@@ -1,18 +1,25 @@
 # %%
 """NOw let's try to do some geolocation shizzle"""
 
+import datetime
 import os
 import shutil
 import tarfile
 from enum import Enum
+from functools import lru_cache
+from pathlib import Path
 import urllib.request
 
 
 import geoip2.database
+import geoip2.errors
+import maxminddb
 import polars as pl
 from dotenv import load_dotenv
+from sqlalchemy import Connection, Table, select
 
 from log_parsing.config import PROJECT_ROOT, logger
+from log_parsing.database_def import TableNames, create_engine_table
 
 load_dotenv()
 GEOIP_LICENSE_KEY = os.getenv("GEOIP_LICENSE_KEY")
@@ -65,89 +72,286 @@ def download_geolitedate(
 download_geolitedate(GeoliteDatabaseTypes.CITY)
 
 
-def get_geolite_reader(database_type: GeoliteDatabaseTypes) -> geoip2.database.Reader:
-    _, path = geolite_databases[database_type]
-    return geoip2.database.Reader(path)
-
-
-def map_country_name(addr: pl.Series) -> pl.Series:
-    logger.info(f"Getting country info for {len(addr)} addresses.")
-    with get_geolite_reader(GeoliteDatabaseTypes.COUNTRY) as reader:
-
-        def get_country(addr: str) -> str:
-            response = reader.country(addr)
-            name = response.country.name
-            if name is None:
-                return "unknown"
-            return name
-
-        res = addr.apply(get_country).alias("country")
-    return res
-
-
-def map_country_iso_code(addr: pl.Series) -> pl.Series:
-    logger.info(f"Getting country info for {len(addr)} addresses.")
-    with get_geolite_reader(GeoliteDatabaseTypes.COUNTRY) as reader:
-
-        def get_country(addr: str) -> str:
-            response = reader.country(addr)
-            name = response.country.iso_code
-            if name is None:
-                return "unknown"
-            return name
-
-        res = addr.apply(get_country).alias("country")
-    return res
-
-
-def map_timezone(addr: pl.Series) -> pl.Series:
-    with get_geolite_reader(GeoliteDatabaseTypes.CITY) as reader:
-
-        def get_timezone(addr: str) -> str:
-            response = reader.city(addr)
-            timezone = response.location.time_zone
-            if timezone is None:
-                timezone = "UTC"
-            return timezone
-
-        timezones = addr.apply(get_timezone).alias("timezone")
-    return timezones
-
-
-def map_continent(addr: pl.Series) -> pl.Series:
-    with get_geolite_reader(GeoliteDatabaseTypes.CITY) as reader:
-
-        def get_continent(addr: str) -> str:
-            response = reader.city(addr)
-            continent = response.continent.name
-            if continent is None:
-                continent = "unknown"
-            return continent
-
-        continents = addr.apply(get_continent).alias("continent")
-    return continents
-
-
-def get_local_time(group_df: pl.DataFrame):
-    tz = group_df["timezone"][0]
-
-    return group_df.select(["request_id", "time"]).with_columns(
-        (
-            pl.col("time")
-            .dt.replace_time_zone("UTC")
-            .dt.convert_time_zone(tz)
-            .dt.replace_time_zone(None)
-        ).alias("local_time")
+GEO_INFO_COLUMNS = ["timezone", "country", "country_iso", "continent"]
+
+
+def open_mmdb(path: Path) -> geoip2.database.Reader:
+    """
+    Open a geolite database memory-mapped, using the C extension of `maxminddb` if
+    it is available. The mapped pages are shared with forked worker processes.
+    """
+    try:
+        return geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP_EXT)
+    except (ImportError, ValueError):
+        return geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP)
+
+
+class GeoliteReader:
+    """
+    Long-lived reader of a geolite database with an LRU cache of at most
+    `cache_size` addresses in front of the lookups.
+    """
+
+    def __init__(self, database_type: GeoliteDatabaseTypes, cache_size: int = 2**16):
+        _, self.path = geolite_databases[database_type]
+        self.mtime_ns = self.path.stat().st_mtime_ns
+        self.reader = open_mmdb(self.path)
+        self.mmdb_build: int = self.reader.metadata().build_epoch
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, addr: str) -> tuple[str, str, str, str]:
+        """
+        Look up the timezone, country name, country ISO code and continent of a
+        single address. Missing fields are reported as "UTC" (timezone) or
+        "unknown".
+        """
+        try:
+            response = self.reader.city(addr)
+        except geoip2.errors.AddressNotFoundError:
+            return "UTC", "unknown", "unknown", "unknown"
+        timezone = response.location.time_zone
+        if timezone is None:
+            timezone = "UTC"
+        country = response.country.name
+        if country is None:
+            country = "unknown"
+        country_iso = response.country.iso_code
+        if country_iso is None:
+            country_iso = "unknown"
+        continent = response.continent.name
+        if continent is None:
+            continent = "unknown"
+        return timezone, country, country_iso, continent
+
+    @property
+    def hit_rate(self) -> float:
+        cache_info = self.lookup.cache_info()
+        num_lookups = cache_info.hits + cache_info.misses
+        if num_lookups == 0:
+            return 0.0
+        return cache_info.hits / num_lookups
+
+    def is_outdated(self) -> bool:
+        """Whether the database file changed since it was opened."""
+        return self.path.stat().st_mtime_ns != self.mtime_ns
+
+    def close(self):
+        self.lookup.cache_clear()
+        self.reader.close()
+
+
+_geolite_readers: dict[GeoliteDatabaseTypes, GeoliteReader] = {}
+
+
+def get_geolite_reader(database_type: GeoliteDatabaseTypes) -> GeoliteReader:
+    """
+    Return the reader of this process for the database, reopening it if the file
+    was replaced (e.g. by `download_geolitedate`).
+    """
+    reader = _geolite_readers.get(database_type)
+    if reader is not None and reader.is_outdated():
+        reader.close()
+        reader = None
+    if reader is None:
+        reader = GeoliteReader(database_type)
+        _geolite_readers[database_type] = reader
+    return reader
+
+
+def lookup_geo_info(addr: pl.Series) -> pl.DataFrame:
+    """
+    Look up the geo info of every distinct address in `addr` with a single pass
+    over the City database.
+
+    Returns a dataframe with an `addr` column and the columns in `GEO_INFO_COLUMNS`.
+    """
+    unique_addr = addr.drop_nulls().unique()
+    logger.info(
+        f"Getting geo info for {len(unique_addr)} distinct out of "
+        f"{len(addr)} addresses."
     )
-
-
-def add_country_info(df: pl.DataFrame) -> pl.DataFrame:
+    reader = get_geolite_reader(GeoliteDatabaseTypes.CITY)
+    rows = [(a, *reader.lookup(a)) for a in unique_addr]
+    logger.info(f"Geo lookup cache hit rate {reader.hit_rate:.1%}")
+    schema = [(column, pl.Utf8) for column in ["addr", *GEO_INFO_COLUMNS]]
+    return pl.DataFrame(rows, schema=schema, orient="row")
+
+
+def get_mmdb_build(database_type: GeoliteDatabaseTypes) -> int:
+    """Return the build timestamp of the geolite database on disk."""
+    return get_geolite_reader(database_type).mmdb_build
+
+
+def read_geo_cache(
+    conn: Connection,
+    cache: Table,
+    addr: pl.Series,
+    mmdb_build: int,
+    chunk_size: int = 500,
+) -> pl.DataFrame:
+    """
+    Read the cached geo info of the addresses in `addr` that were looked up in the
+    City database with build `mmdb_build`.
+    """
+    columns = [cache.c[column] for column in ["addr", *GEO_INFO_COLUMNS]]
+    addr_list = addr.to_list()
+    rows: list[tuple] = []
+    for i in range(0, len(addr_list), chunk_size):
+        stmt = select(*columns).where(
+            cache.c.mmdb_build == mmdb_build,
+            cache.c.addr.in_(addr_list[i : i + chunk_size]),
+        )
+        rows.extend(tuple(row) for row in conn.execute(stmt))
+    schema = [(column, pl.Utf8) for column in ["addr", *GEO_INFO_COLUMNS]]
+    return pl.DataFrame(rows, schema=schema, orient="row")
+
+
+def update_geo_cache(
+    conn: Connection, cache: Table, geo_df: pl.DataFrame, mmdb_build: int
+):
+    """
+    Store the geo info in `geo_df` in the cache, replacing entries of older builds.
+    Does not commit.
+    """
+    if len(geo_df) == 0:
+        return
+    geo_df = (
+        geo_df.select(["addr", *GEO_INFO_COLUMNS])
+        .drop_nulls("addr")
+        .with_columns(pl.lit(mmdb_build).alias("mmdb_build"))
+    )
+    conn.execute(cache.insert().prefix_with("OR REPLACE"), geo_df.to_dicts())
+
+
+def lookup_geo_info_cached(addr: pl.Series, update_cache: bool = True) -> pl.DataFrame:
+    """
+    Like `lookup_geo_info`, but only look up the addresses that are not yet in the
+    `ip_geo_cache` table for the current build of the City database.
+
+    If `update_cache` is True, the newly looked up addresses are added to the
+    cache.
+    """
+    engine, tables = create_engine_table()
+    cache = tables[TableNames.IP_GEO_CACHE]
+    mmdb_build = get_mmdb_build(GeoliteDatabaseTypes.CITY)
+    unique_addr = addr.drop_nulls().unique()
+    with engine.connect() as conn:
+        cached_df = read_geo_cache(conn, cache, unique_addr, mmdb_build)
+        missing_addr = unique_addr.filter(~unique_addr.is_in(cached_df["addr"]))
+        logger.info(
+            f"Found {len(cached_df)} of {len(unique_addr)} addresses in geo cache."
+        )
+        new_df = lookup_geo_info(missing_addr)
+        if update_cache:
+            update_geo_cache(conn, cache, new_df, mmdb_build)
+            conn.commit()
+    return pl.concat([cached_df, new_df])
+
+
+def utc_offsets(time: pl.Series, tz: str) -> pl.Series:
+    """UTC offset in seconds of `tz` at each of the (naive, UTC) times in `time`."""
+    # Casting between time zones converts like `dt.convert_time_zone`, but skips
+    # its lookup of `zoneinfo.available_timezones()` on every call.
+    local_time = (
+        time.cast(pl.Datetime("us", "UTC"))
+        .cast(pl.Datetime("us", tz))
+        .dt.replace_time_zone(None)
+    )
+    return (local_time - time).dt.seconds()
+
+
+@lru_cache(maxsize=None)
+def get_offset_transitions(
+    tz: str, year: int
+) -> tuple[list[datetime.datetime], list[int]]:
+    """
+    Return the (naive, UTC) instants during `year` from which on the UTC offset of
+    `tz` changes, together with the offsets in seconds from those instants on. The
+    first instant is the start of the year.
+
+    Transitions are found on an hourly grid and then located to the second, using
+    the same timezone database as `dt.convert_time_zone`.
+    """
+    hours = pl.date_range(
+        datetime.datetime(year, 1, 1),
+        datetime.datetime(year + 1, 1, 1),
+        "1h",
+        closed="left",
+        time_unit="us",
+        eager=True,
+    )
+    hour_offsets = utc_offsets(hours, tz)
+    starts = [hours[0]]
+    offsets = [hour_offsets[0]]
+    for i in (hour_offsets != hour_offsets.shift(1)).arg_true()[1:]:
+        seconds = pl.date_range(
+            hours[i - 1], hours[i], "1s", time_unit="us", eager=True
+        )
+        second_offsets = utc_offsets(seconds, tz)
+        j = (second_offsets != second_offsets[0]).arg_true()[0]
+        starts.append(seconds[j])
+        offsets.append(second_offsets[j])
+    return starts, offsets
+
+
+def make_offset_table(keys: pl.DataFrame) -> pl.DataFrame:
+    """
+    For each `timezone` and `year` in `keys`, make a row with the offset
+    transitions of that year as columns `_start_0`, `_offset_0`, `_start_1`, ...
+    Years with fewer transitions are padded with nulls.
+    """
+    transitions = [get_offset_transitions(tz, year) for tz, year in keys.rows()]
+    num_transitions = max(len(starts) for starts, _ in transitions)
+    columns: dict[str, list] = {
+        "timezone": keys["timezone"].to_list(),
+        "_year": keys["_year"].to_list(),
+    }
+    for k in range(num_transitions):
+        columns[f"_start_{k}"] = [
+            starts[k] if k < len(starts) else None for starts, _ in transitions
+        ]
+        columns[f"_offset_{k}"] = [
+            offsets[k] if k < len(offsets) else None for _, offsets in transitions
+        ]
+    schema = {"timezone": pl.Utf8, "_year": keys["_year"].dtype}
+    for k in range(num_transitions):
+        schema[f"_start_{k}"] = pl.Datetime("us")
+        schema[f"_offset_{k}"] = pl.Int64
+    return pl.DataFrame(columns, schema=schema)
+
+
+def add_local_time(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Add a `local_time` column with the (naive, UTC) `time` converted to the
+    `timezone` of each row.
+
+    The UTC offset of each row is looked up in a table of offset transitions
+    joined on timezone and year, so no per-timezone Python code runs on the rows.
+    """
+    df = df.with_columns(pl.col("time").dt.year().alias("_year"))
+    keys = df.select(["timezone", "_year"]).unique().drop_nulls()
+    if len(keys) == 0:
+        local_time = pl.lit(None, dtype=df["time"].dtype).alias("local_time")
+        return df.drop("_year").with_columns(local_time)
+    offset_table = make_offset_table(keys)
+    num_transitions = (len(offset_table.columns) - 2) // 2
+
+    utc_offset = pl.col("_offset_0")
+    for k in range(1, num_transitions):
+        utc_offset = (
+            pl.when(pl.col("time") >= pl.col(f"_start_{k}"))
+            .then(pl.col(f"_offset_{k}"))
+            .otherwise(utc_offset)
+        )
+    df = df.join(offset_table, on=["timezone", "_year"], how="left")
     df = df.with_columns(
-        pl.col("addr").map(map_timezone).alias("timezone"),
-        pl.col("addr").map(map_country_name).alias("country"),
-        pl.col("addr").map(map_country_iso_code).alias("country_iso"),
-        pl.col("addr").map(map_continent).alias("continent"),
+        (pl.col("time") + pl.duration(seconds=utc_offset)).alias("local_time")
     )
-    df_tz = df.groupby("timezone").apply(get_local_time).sort(by=pl.col("request_id"))
-    df = df.sort(by=pl.col("request_id")).with_columns(df_tz["local_time"])
+    return df.drop(offset_table.columns[1:])
+
+
+def add_country_info(df: pl.DataFrame, update_cache: bool = True) -> pl.DataFrame:
+    geo_df = lookup_geo_info_cached(df["addr"], update_cache=update_cache)
+    df = df.join(geo_df, on="addr", how="left")
+    df = add_local_time(df)
     return df
@@ -0,0 +1,101 @@
+# %%
+"""
+Reading log files, plain or compressed with gzip or zstd as rotated by logrotate
+(`access.log.1`, `access.log.2.gz`, ...), without decompressing them to disk.
+"""
+
+import gzip
+import io
+import queue
+import re
+import threading
+from itertools import islice
+from pathlib import Path
+from typing import AnyStr, BinaryIO, Iterable, Iterator
+
+import zstandard
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+LOG_FILE_REGEX = re.compile(r"\.log(\.\d+)?(\.gz|\.zst)?$")
+READ_BUFFER_SIZE = 1 << 20
+
+
+def is_log_file(path: Path) -> bool:
+    return path.is_file() and LOG_FILE_REGEX.search(path.name) is not None
+
+
+def open_log_file(log_file: Path) -> BinaryIO:
+    """
+    Open a log file for reading its decompressed bytes. The compression is detected
+    from the start of the file; files of several gzip members or zstd frames, as made
+    by appending compressed files, are read in full.
+    """
+    with open(log_file, "rb") as log_file_stream:
+        magic = log_file_stream.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(log_file, "rb")  # type: ignore
+    if magic == ZSTD_MAGIC:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(log_file, "rb"), read_across_frames=True
+        )
+        return io.BufferedReader(reader, READ_BUFFER_SIZE)  # type: ignore
+    return open(log_file, "rb")
+
+
+def skip_bytes(stream: BinaryIO, num_bytes: int):
+    """Move `num_bytes` forward, decompressing and dropping them if not seekable"""
+    if stream.seekable():
+        stream.seek(num_bytes, io.SEEK_CUR)
+        return
+    while num_bytes > 0:
+        data = stream.read(min(num_bytes, READ_BUFFER_SIZE))
+        if len(data) == 0:
+            break
+        num_bytes -= len(data)
+
+
+def iter_line_chunks(
+    lines: Iterable[AnyStr], chunk_size: int, prefetch: int = 2
+) -> Iterator[list[AnyStr]]:
+    """
+    Yield lists of `chunk_size` lines. The lines are read on another thread, at most
+    `prefetch` chunks ahead, so reading and decompressing overlaps with the work on
+    the chunks.
+    """
+    chunks: queue.Queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_chunks():
+        line_iter = iter(lines)
+        try:
+            while True:
+                chunk = list(islice(line_iter, chunk_size))
+                if not put(chunk) or len(chunk) == 0:
+                    return
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read_chunks, name="read-lines", daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if len(chunk) == 0:
+                break
+            yield chunk
+    finally:
+        # Also stops the reader if the consumer stops early
+        stop.set()
+        reader.join()
@@ -0,0 +1,227 @@
+# %%
+"""
+Columnar copy of the `pages_log` table as Parquet files, partitioned by month.
+
+The store is written next to the SQLite database when `USE_PARQUET_STORE` is set,
+and lets readers load only the months and columns they need. It is only read once
+`rebuild_parquet_store` has built it from `pages_log`, which writes a marker file;
+until then `pages_log` is read from SQLite.
+
+Each month is a directory holding a compacted `pages.parquet` and the batch files
+added since, one per `write_pages_parquet` call, so adding rows doesn't rewrite the
+month. The batch files are merged into `pages.parquet` once a month has
+`PARQUET_MAX_BATCH_FILES` of them, when a later month is written, and on a rebuild.
+"""
+
+import datetime
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import polars as pl
+from sqlalchemy import DateTime, Float, Integer, String, Table, func, select
+
+from log_parsing.config import DATA_PATH, USE_PARQUET_STORE, logger
+from log_parsing.database_def import (
+    TableNames,
+    create_engine_table,
+    read_sql_select,
+)
+
+PAGES_PARQUET_PATH = DATA_PATH / "pages_parquet"
+PAGES_PARQUET_COMPLETE_PATH = PAGES_PARQUET_PATH / "_COMPLETE"
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+PARQUET_MAX_BATCH_FILES = 100
+
+
+def table_schema(table: Table) -> dict[str, pl.PolarsDataType]:
+    """The schema of a table as read back with `pl.read_sql`."""
+    polars_types: dict[type, pl.PolarsDataType] = {
+        Integer: pl.Int64,
+        Float: pl.Float64,
+        String: pl.Utf8,
+        DateTime: pl.Datetime("ns"),
+    }
+    return {column.name: polars_types[type(column.type)] for column in table.columns}
+
+
+def partition_dir(month: str) -> Path:
+    return PAGES_PARQUET_PATH / f"month={month}"
+
+
+def partition_month(month_dir: Path) -> str:
+    return month_dir.name.removeprefix("month=")
+
+
+def batch_paths(month_dir: Path) -> list[Path]:
+    """The batch files of a month, oldest first"""
+    return sorted(month_dir.glob("batch-*.parquet"))
+
+
+def partition_files(month_dir: Path) -> list[Path]:
+    """The compacted file, if any, and the batch files of a month"""
+    compacted = [month_dir / "pages.parquet"]
+    return [path for path in compacted if path.exists()] + batch_paths(month_dir)
+
+
+# Only warned about once per process, as the store is checked on every read
+@lru_cache(maxsize=1)
+def warn_store_not_built():
+    logger.warning(
+        "USE_PARQUET_STORE is set, but the Parquet store has not been built; "
+        "using SQLite. Run `python -m log_parsing.parquet_store` to build it."
+    )
+
+
+def use_parquet_store() -> bool:
+    """Whether `pages_log` should be read from, and written to, the store."""
+    if not USE_PARQUET_STORE:
+        return False
+    if not PAGES_PARQUET_COMPLETE_PATH.exists():
+        warn_store_not_built()
+        return False
+    return True
+
+
+def write_parquet(df: pl.DataFrame, path: Path):
+    """Write `df` to `path`, replacing it only once it is written completely"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    df.write_parquet(tmp_path, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    tmp_path.replace(path)
+
+
+def read_partition(month_dir: Path) -> pl.LazyFrame:
+    """
+    Lazily scan the files of a month. The rows of the batch files are deduplicated
+    on `request_id`, keeping the first, like the INSERT OR IGNORE into `pages_log`;
+    the compacted file has no duplicates.
+    """
+    paths = partition_files(month_dir)
+    pages = pl.concat([pl.scan_parquet(path) for path in paths])
+    if len(paths) > 1:
+        pages = pages.unique(
+            subset="request_id", keep="first", maintain_order=True
+        ).sort("time")
+    return pages
+
+
+def compact_partition(month_dir: Path):
+    """
+    Merge the batch files of a month into its `pages.parquet`. The batch files are
+    only removed after it is replaced; until then they are deduplicated on reading.
+    """
+    paths = batch_paths(month_dir)
+    if len(paths) == 0:
+        return
+    month_df = read_partition(month_dir).collect()
+    write_parquet(month_df, month_dir / "pages.parquet")
+    for path in paths:
+        path.unlink()
+    logger.info(f"Compacted {len(paths)} batch files into {len(month_df)} rows")
+
+
+def to_store_schema(pages_df: pl.DataFrame) -> pl.DataFrame:
+    _, tables = create_engine_table()
+    schema = table_schema(tables[TableNames.PAGES_LOG])
+    return pages_df.select(
+        [pl.col(column).cast(dtype) for column, dtype in schema.items()]
+    )
+
+
+def write_pages_parquet(pages_df: pl.DataFrame):
+    """
+    Add the rows of `pages_df` to the store, as a new batch file sorted by time in
+    each month touched. Rows whose `request_id` is already stored are ignored on
+    reading, like the INSERT OR IGNORE into `pages_log`.
+
+    Called before the rows are committed to `pages_log`, so if that commit doesn't
+    happen the rows are derived and written again on the next run instead of
+    missing from the store.
+    """
+    pages_df = to_store_schema(pages_df)
+    months = pages_df.with_columns(pl.col("time").dt.strftime("%Y-%m").alias("_month"))
+    month_dfs = months.partition_by("_month", as_dict=True)
+    batch_name = f"batch-{time.time_ns()}.parquet"
+    for month, month_df in month_dfs.items():
+        month_dir = partition_dir(month)
+        write_parquet(month_df.drop("_month").sort("time"), month_dir / batch_name)
+        logger.info(f"Wrote {len(month_df)} rows to {month_dir / batch_name}")
+        if len(batch_paths(month_dir)) >= PARQUET_MAX_BATCH_FILES:
+            compact_partition(month_dir)
+
+    # Months before the latest one written get few rows after it, so compact them
+    latest_month = max(month_dfs)
+    for month_dir in PAGES_PARQUET_PATH.glob("month=*"):
+        if partition_month(month_dir) < latest_month:
+            compact_partition(month_dir)
+
+
+def list_partitions(
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+) -> list[Path]:
+    """The month directories overlapping the date range, in chronological order."""
+    month_dirs = []
+    for month_dir in sorted(PAGES_PARQUET_PATH.glob("month=*")):
+        month = partition_month(month_dir)
+        if start_date is not None and month < start_date.strftime("%Y-%m"):
+            continue
+        if end_date is not None and month > end_date.strftime("%Y-%m"):
+            continue
+        if len(partition_files(month_dir)) > 0:
+            month_dirs.append(month_dir)
+    return month_dirs
+
+
+def scan_pages_parquet(
+    columns: list[str] | None = None,
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scan the store, reading only the partitions in the date range. The
+    filter on `time` and the column selection are pushed down into the Parquet
+    reader.
+    """
+    _, tables = create_engine_table()
+    schema = table_schema(tables[TableNames.PAGES_LOG])
+    month_dirs = list_partitions(start_date, end_date)
+    if len(month_dirs) == 0:
+        pages = pl.DataFrame(schema=schema).lazy()
+    else:
+        pages = pl.concat([read_partition(month_dir) for month_dir in month_dirs])
+    if start_date is not None:
+        pages = pages.filter(pl.col("time") >= start_date)
+    if end_date is not None:
+        pages = pages.filter(pl.col("time") <= end_date)
+    if columns is not None:
+        pages = pages.select(columns)
+    return pages
+
+
+def rebuild_parquet_store():
+    """
+    (Re)write the store from the `pages_log` table, one compacted file per month,
+    and mark it as complete.
+    """
+    _, tables = create_engine_table()
+    pages_log = tables[TableNames.PAGES_LOG]
+    PAGES_PARQUET_COMPLETE_PATH.unlink(missing_ok=True)
+    for path in PAGES_PARQUET_PATH.glob("month=*/*.parquet"):
+        path.unlink()
+
+    month = func.substr(pages_log.c.time, 1, 7)
+    months = read_sql_select(select(month.label("month")).distinct())["month"]
+    for month_value in months.sort():
+        month_df = read_sql_select(select(pages_log).where(month == month_value))
+        month_df = to_store_schema(month_df)
+        path = partition_dir(month_value) / "pages.parquet"
+        write_parquet(month_df.sort("time"), path)
+        logger.info(f"Wrote {len(month_df)} rows to {path}")
+    PAGES_PARQUET_PATH.mkdir(parents=True, exist_ok=True)
+    PAGES_PARQUET_COMPLETE_PATH.touch()
+
+
+if __name__ == "__main__":
+    rebuild_parquet_store()
@@ -1,27 +1,65 @@
 # %%
+import argparse
+import datetime
+import hashlib
+import io
 import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from enum import Enum
+from itertools import islice
+from pathlib import Path
 
-import dateutil.parser
 import polars as pl
 from io import TextIOWrapper
+from sqlalchemy import Connection, Float, Integer, String, Table, exists, select
 from time import perf_counter
+from typing import Any, Iterable
 
-from log_parsing.database_def import TableNames, create_engine_table
+from log_parsing.database_def import (
+    TableNames,
+    create_engine_table,
+    read_sql_select,
+)
 from log_parsing.config import PROJECT_ROOT, logger
-from log_parsing.geolocation import add_country_info
+from log_parsing.geolocation import (
+    GEO_INFO_COLUMNS,
+    GeoliteDatabaseTypes,
+    add_country_info,
+    get_mmdb_build,
+    update_geo_cache,
+)
+from log_parsing.log_files import (
+    is_log_file,
+    iter_line_chunks,
+    open_log_file,
+    skip_bytes,
+)
+from log_parsing.parquet_store import use_parquet_store, write_pages_parquet
+from log_parsing.query import scan_table
+from log_parsing.rollup import update_pages_rollup
+from log_parsing.timestamps import nginx_time_local, nginx_time_utc, parse_nginx_time
 
 
 def parse_data(data: dict, columns) -> dict:
     data = {k: v for k, v in data.items() if k in columns}
-    time = dateutil.parser.isoparse(data["time_iso8601"])
+    time = parse_nginx_time(data["time_iso8601"])
     data["time_iso8601"] = time
     return data
 
 
-def ingest_access_log(log_file: TextIOWrapper):
+def ingest_access_log(log_file: Iterable[str], columnar: bool = False):
     """
     Ingest the access log into the database.
+
+    If `columnar` is True, the log is read in chunks of lines which are parsed and
+    inserted as Polars frames instead of line by line; see
+    `ingest_access_log_columnar`.
     """
+    if columnar:
+        return ingest_access_log_columnar(log_file)
+
     engine, tables = create_engine_table()
     access_log = tables[TableNames.ACCESS_LOG]
     columns = frozenset(access_log.columns.keys())
@@ -57,9 +95,146 @@ def ingest_access_log(log_file: TextIOWrapper):
     return min_date, max_date
 
 
-def make_pages_df(df: pl.DataFrame):
+def parse_access_chunk(lines: list[str], columns) -> pl.DataFrame:
+    """
+    Parse a chunk of NDJSON lines of the access log into a dataframe.
+
+    Only the keys in `columns` are kept. The `time_iso8601` column is parsed in one
+    pass into the instant in UTC (`time_utc`) and the wall-clock time in the offset
+    written by nginx (`time_iso8601`), the latter being what the row-based ingest
+    stores in the database.
+
+    Raises a ValueError if a line is not valid JSON.
+    """
+    chunk_df = pl.read_ndjson(io.BytesIO("".join(lines).encode()))
+    if len(chunk_df) != len(lines):
+        # `read_ndjson` silently stops at the first malformed line
+        raise_malformed_line(lines)
+    chunk_df = chunk_df.select([c for c in chunk_df.columns if c in columns])
+    time_str = pl.col("time_iso8601")
+    return chunk_df.with_columns(
+        time_str.alias("time_raw"),
+        nginx_time_utc(time_str).alias("time_utc"),
+        nginx_time_local(time_str).alias("time_iso8601"),
+    )
+
+
+def raise_malformed_line(lines: list[str]):
+    for i, line in enumerate(lines):
+        try:
+            json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Malformed line {i + 1} of chunk: {line!r}") from e
+    raise ValueError(f"Parsed fewer rows than the {len(lines)} lines of chunk")
+
+
+def chunk_time_range(
+    chunk_df: pl.DataFrame,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """
+    Return the earliest and latest `time_iso8601` of a parsed chunk, with the same
+    timezone offset as in the log (as `dateutil.parser.isoparse` would return).
+    """
+    time_raw = chunk_df["time_raw"]
+    time_utc = chunk_df["time_utc"]
+    min_index = time_utc.arg_min()
+    max_index = time_utc.arg_max()
+    if min_index is None or max_index is None:
+        raise ValueError("Chunk has no times")
+    min_date = parse_nginx_time(time_raw[min_index])
+    max_date = parse_nginx_time(time_raw[max_index])
+    return min_date, max_date
+
+
+INSERT_BATCH_SIZE = 10_000
+
+
+def insert_or_ignore_df(
+    conn: Connection,
+    table: Table,
+    df: pl.DataFrame,
+    batch_size: int = INSERT_BATCH_SIZE,
+    batches_per_commit: int | None = None,
+) -> None:
+    """
+    Insert all rows of `df` into `table`, ignoring rows whose primary key already
+    exists.
+
+    The rows are passed to the driver with one prepared `executemany` per batch of
+    `batch_size` rows, so only one batch is converted to Python tuples at a time.
+    Datetime columns are formatted the same way SQLAlchemy stores them in SQLite.
+    If `batches_per_commit` is given, the transaction is committed after that
+    many batches and at the end; otherwise committing is left to the caller.
+    """
+    df = df.select([c for c in table.columns.keys() if c in df.columns])
+    datetime_columns = [c for c, dtype in df.schema.items() if dtype == pl.Datetime]
+    df = df.with_columns(
+        pl.col(datetime_columns).dt.strftime("%Y-%m-%d %H:%M:%S%.6f"),
+    )
+    stmt = table.insert().prefix_with("OR IGNORE")
+    compiled = str(stmt.compile(dialect=conn.dialect, column_keys=df.columns))
+    for i, batch in enumerate(df.iter_slices(batch_size), start=1):
+        conn.exec_driver_sql(compiled, batch.rows())
+        if batches_per_commit is not None and i % batches_per_commit == 0:
+            conn.commit()
+    if batches_per_commit is not None:
+        conn.commit()
+
+
+def ingest_access_log_columnar(log_file: Iterable[str], chunk_size: int = 100_000):
+    """
+    Ingest the access log into the database, reading `chunk_size` lines at a time
+    into a Polars frame.
+
+    Produces the same `access_log` rows and return value as `ingest_access_log`.
+    """
+    engine, tables = create_engine_table()
+    access_log = tables[TableNames.ACCESS_LOG]
+    columns = frozenset(access_log.columns.keys())
+
+    min_date = None
+    max_date = None
+    tot_num_entries = 0
+    with engine.connect() as conn:
+        for lines in iter_line_chunks(log_file, chunk_size):
+            chunk_df = parse_access_chunk(lines, columns)
+
+            chunk_min, chunk_max = chunk_time_range(chunk_df)
+            if min_date is None or chunk_min < min_date:
+                min_date = chunk_min
+            if max_date is None or chunk_max > max_date:
+                max_date = chunk_max
+            insert_or_ignore_df(conn, access_log, chunk_df)
+            tot_num_entries += len(chunk_df)
+        conn.commit()
+    logger.info(
+        f"Commited {tot_num_entries} from access log "
+        f"with date range {min_date} to {max_date}"
+    )
+    return min_date, max_date
+
+
+ACCESS_TO_PAGES_REMAP = {"time_iso8601": "time", "http_x_forwarded_for": "addr"}
+
+
+def cast_to_table_types(df: pl.DataFrame, table: Table) -> pl.DataFrame:
+    """
+    Cast the columns of `df` to the types they get when read back from `table`.
+    """
+    polars_types = {Integer: pl.Int64, Float: pl.Float64, String: pl.Utf8}
+    casts = []
+    for column in table.columns:
+        polars_type = polars_types.get(type(column.type))
+        if column.name in df.columns and polars_type is not None:
+            casts.append(pl.col(column.name).cast(polars_type, strict=False))
+    return df.with_columns(casts)
+
+
+def make_pages_df(df: pl.DataFrame, update_cache: bool = True):
     """
     Parse the `access_log` table to create the `pages_log` table.
+
+    If `update_cache` is False, the `ip_geo_cache` table is only read from.
     """
     df_pages = df.filter(
         (pl.col("request_uri").str.ends_with("/")) & (pl.col("status") == 200)
@@ -81,30 +256,54 @@ def make_pages_df(df: pl.DataFrame):
             ),
         ]
     )
-    df_pages = add_country_info(df_pages)
+    df_pages = add_country_info(df_pages, update_cache=update_cache)
     df_pages = df_pages.drop("request_uri")
     return df_pages
 
 
+def pages_time_range(
+    pages_df: pl.DataFrame,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """The earliest and latest `time` of a pages dataframe with rows"""
+    start_date = pages_df["time"].min()
+    end_date = pages_df["time"].max()
+    if not isinstance(start_date, datetime.datetime) or not isinstance(
+        end_date, datetime.datetime
+    ):
+        raise ValueError("Pages dataframe has no times")
+    return start_date, end_date
+
+
 # %%
 
 
-def make_insert_pages(start_date, end_date):
+def make_insert_pages(start_date=None, end_date=None, incremental: bool = True):
     """
     Wrangle the data from the `access_log` table in between start_date and end_date
-    and upsert in the `pages_log` table.
+    and upsert in the `pages_log` table. A missing date means the window is
+    unbounded on that side.
+
+    If `incremental` is True, only the page requests of `access_log` that have no
+    row in `pages_log` yet are read, so rows processed before are not enriched
+    again.
     """
     engine, tables = create_engine_table()
     access_log = tables[TableNames.ACCESS_LOG]
     pages_log = tables[TableNames.PAGES_LOG]
-    db_url = str(engine.url).replace("///", "//")
-    access_df = pl.read_sql(
-        f"SELECT * from {access_log.name} "
-        f"WHERE time_iso8601 >= '{start_date}' AND time_iso8601 <= '{end_date}';",
-        db_url,
-    )
-    remap = {"time_iso8601": "time", "http_x_forwarded_for": "addr"}
-    access_df.columns = [remap.get(c, c) for c in access_df.columns]
+    stmt = select(access_log)
+    if start_date is not None:
+        stmt = stmt.where(access_log.c.time_iso8601 >= start_date)
+    if end_date is not None:
+        stmt = stmt.where(access_log.c.time_iso8601 <= end_date)
+    if incremental:
+        # Same selection of page requests as in `make_pages_df`
+        stmt = stmt.where(
+            access_log.c.request_uri.like("%/"),
+            access_log.c.status == 200,
+            ~exists().where(pages_log.c.request_id == access_log.c.request_id),
+        )
+    access_df = read_sql_select(stmt)
+    access_df.columns = [ACCESS_TO_PAGES_REMAP.get(c, c) for c in access_df.columns]
 
     if len(access_df) == 0:
         logger.info("Empty acces dataframe; skipping")
@@ -117,23 +316,147 @@ def make_insert_pages(start_date, end_date):
 
     logger.info(f"Made pages dataframe with shape {pages_df.shape}")
     with engine.connect() as conn:
-        stmt = pages_log.insert().prefix_with("OR IGNORE").values(pages_df.rows())
-        conn.execute(stmt)
+        insert_or_ignore_df(conn, pages_log, pages_df)
+        update_pages_rollup(conn, tables, *pages_time_range(pages_df))
+        if use_parquet_store():
+            write_pages_parquet(pages_df)
         conn.commit()
     logger.info("Inserted pages dataframe into database.")
 
 
-def load_df_from_db(
-    df_name: TableNames, remap_iso8601: bool = True, extr_sql_stmt: str | None = None
+class IngestStatus(Enum):
+    INGESTING = "ingesting"  # Lines up to `offset` are in `access_log`
+    INGESTED = "ingested"  # All lines are in `access_log`; pages not made yet
+    DONE = "done"
+
+
+# Number of bytes at the start of a log file hashed to identify it
+CHECKPOINT_HASH_BYTES = 1 << 20
+
+
+def log_file_identity(log_file: Path) -> dict[str, Any]:
+    """
+    The identity of a log file in `ingest_checkpoints`; it doesn't change when the
+    file is renamed or moved.
+    """
+    stat = log_file.stat()
+    with open(log_file, "rb") as log_file_stream:
+        head = log_file_stream.read(CHECKPOINT_HASH_BYTES)
+    file_hash = hashlib.sha256(head)
+    file_hash.update(str(stat.st_size).encode())
+    return {
+        "file_key": file_hash.hexdigest(),
+        "file_name": log_file.name,
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+    }
+
+
+def write_checkpoint(
+    conn: Connection,
+    checkpoints: Table,
+    identity: dict[str, Any],
+    offset: int,
+    start_date: datetime.datetime | None,
+    end_date: datetime.datetime | None,
+    status: IngestStatus,
 ):
+    """Store the progress of the ingest of a log file. Does not commit."""
+    conn.execute(
+        checkpoints.insert().prefix_with("OR REPLACE"),
+        {
+            **identity,
+            "offset": offset,
+            "start_date": start_date.isoformat() if start_date else None,
+            "end_date": end_date.isoformat() if end_date else None,
+            "status": status.value,
+        },
+    )
+
+
+def ingest_log_file(log_file: Path, chunk_size: int = 100_000):
+    """
+    Ingest a log file into `access_log` and `pages_log`, resuming where an earlier
+    run on the same file stopped.
+
+    The lines are read `chunk_size` at a time, and each chunk is committed together
+    with the byte offset after it in `ingest_checkpoints`. Once the whole file is
+    ingested, the pages are made for its date range and the checkpoint is marked
+    done.
+    """
     engine, tables = create_engine_table()
-    table = tables[df_name]
-    db_url = str(engine.url).replace("///", "//")
+    access_log = tables[TableNames.ACCESS_LOG]
+    checkpoints = tables[TableNames.INGEST_CHECKPOINTS]
+    columns = frozenset(access_log.columns.keys())
+    identity = log_file_identity(log_file)
+
+    offset = 0
+    start_date = None
+    end_date = None
+    status = IngestStatus.INGESTING
+    with engine.connect() as conn:
+        checkpoint = conn.execute(
+            select(checkpoints).where(checkpoints.c.file_key == identity["file_key"])
+        ).first()
+    if checkpoint is not None:
+        offset = checkpoint.offset
+        if checkpoint.start_date is not None:
+            start_date = datetime.datetime.fromisoformat(checkpoint.start_date)
+            end_date = datetime.datetime.fromisoformat(checkpoint.end_date)
+        status = IngestStatus(checkpoint.status)
+        logger.info(f"Resuming {log_file} at offset {offset} ({status.value})")
 
-    sql_stmt = f"SELECT * from {table.name}"
-    if extr_sql_stmt is not None:
-        sql_stmt += " " + extr_sql_stmt
-    df = pl.read_sql(sql_stmt, db_url)
+    if status == IngestStatus.INGESTING:
+        with engine.connect() as conn, open_log_file(log_file) as log_file_stream:
+            skip_bytes(log_file_stream, offset)
+            for lines in iter_line_chunks(log_file_stream, chunk_size):
+                chunk_df = parse_access_chunk(
+                    [line.decode() for line in lines], columns
+                )
+                chunk_min, chunk_max = chunk_time_range(chunk_df)
+                if start_date is None or chunk_min < start_date:
+                    start_date = chunk_min
+                if end_date is None or chunk_max > end_date:
+                    end_date = chunk_max
+                insert_or_ignore_df(conn, access_log, chunk_df)
+                offset += sum(len(line) for line in lines)
+                write_checkpoint(
+                    conn, checkpoints, identity, offset, start_date, end_date, status
+                )
+                conn.commit()
+            status = IngestStatus.INGESTED
+            write_checkpoint(
+                conn, checkpoints, identity, offset, start_date, end_date, status
+            )
+            conn.commit()
+        logger.info(
+            f"Commited {log_file} up to offset {offset} "
+            f"with date range {start_date} to {end_date}"
+        )
+
+    if status == IngestStatus.INGESTED:
+        make_insert_pages(start_date, end_date)
+        status = IngestStatus.DONE
+        with engine.connect() as conn:
+            write_checkpoint(
+                conn, checkpoints, identity, offset, start_date, end_date, status
+            )
+            conn.commit()
+    return start_date, end_date
+
+
+def load_df_from_db(
+    df_name: TableNames,
+    remap_iso8601: bool = True,
+    columns: list[str] | None = None,
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+    filters: dict[str, Any] | None = None,
+) -> pl.DataFrame:
+    """
+    Load a table into memory; see `scan_table` for the arguments.
+    """
+    df = scan_table(df_name, columns, start_date, end_date, filters).collect()
 
     if remap_iso8601:
         remap = {"time_iso8601": "time"}
@@ -141,10 +464,10 @@ def load_df_from_db(
     return df
 
 
-def parse_ingest_file(file: TextIOWrapper):
+def parse_ingest_file(file: TextIOWrapper, columnar: bool = False):
     time_before = perf_counter()
     logger.info("Ingesting access log into database")
-    start_date, end_date = ingest_access_log(file)
+    start_date, end_date = ingest_access_log(file, columnar=columnar)
     time_taken_ms = (perf_counter() - time_before) * 1000
     logger.info(f"Ingest took {time_taken_ms:.2f} ms")
 
@@ -155,20 +478,191 @@ def parse_ingest_file(file: TextIOWrapper):
     logger.info(f"Reparse took {time_taken_ms:.2f} ms")
 
 
-def _main():
+def parse_log_file(
+    log_file: Path, chunk_size: int = 100_000
+) -> tuple[pl.DataFrame, pl.DataFrame, int]:
+    """
+    Parse a log file into its `access_log` and `pages_log` rows without touching
+    the database, and return them with the number of bytes read. Used by the
+    workers of `_main`.
+    """
+    _, tables = create_engine_table()
+    access_log = tables[TableNames.ACCESS_LOG]
+    columns = frozenset(access_log.columns.keys())
+
+    chunk_dfs = []
+    offset = 0
+    with open_log_file(log_file) as log_file_stream:
+        for lines in iter_line_chunks(log_file_stream, chunk_size):
+            text_lines = [line.decode() for line in lines]
+            chunk_dfs.append(parse_access_chunk(text_lines, columns))
+            offset += sum(len(line) for line in lines)
+    if len(chunk_dfs) == 0:
+        return pl.DataFrame(), pl.DataFrame(), offset
+    access_df = pl.concat(chunk_dfs, how="diagonal").unique(
+        subset="request_id", keep="first", maintain_order=True
+    )
+
+    pages_access_df = cast_to_table_types(access_df, access_log).rename(
+        ACCESS_TO_PAGES_REMAP
+    )
+    pages_df = make_pages_df(pages_access_df, update_cache=False)
+    logger.info(f"Parsed {log_file} into {len(access_df)} rows")
+    return access_df, pages_df, offset
+
+
+def stored_request_ids(
+    conn: Connection, table: Table, request_ids: list[str], chunk_size: int = 500
+) -> set[str]:
+    """The ids in `request_ids` that already have a row in `table`"""
+    stored: set[str] = set()
+    for i in range(0, len(request_ids), chunk_size):
+        stmt = select(table.c.request_id).where(
+            table.c.request_id.in_(request_ids[i : i + chunk_size])
+        )
+        stored.update(conn.execute(stmt).scalars())
+    return stored
+
+
+def _main_parallel(log_files: list[Path], log_parsed: Path, workers: int):
+    """
+    Parse the log files with a pool of `workers` processes. The current process is
+    the only one writing to the database; it inserts the results in the order of
+    `log_files`, so the outcome is the same as for a sequential run. The workers
+    only read the geo cache; it is updated here from the parsed pages.
+
+    The pages of request ids already in `access_log` are dropped, since the stored
+    row is kept rather than the parsed one, and its pages were made when it was
+    stored.
+
+    A file is inserted in one transaction, together with its `ingest_checkpoints`
+    row marked done; files already done are skipped. Files left halfway by a
+    sequential run are resumed with `ingest_log_file` here.
+    """
+    engine, tables = create_engine_table()
+    checkpoints = tables[TableNames.INGEST_CHECKPOINTS]
+    mmdb_build = get_mmdb_build(GeoliteDatabaseTypes.CITY)
+
+    identities = {log_file: log_file_identity(log_file) for log_file in log_files}
+    with engine.connect() as conn:
+        statuses = {
+            file_key: IngestStatus(status)
+            for file_key, status in conn.execute(
+                select(checkpoints.c.file_key, checkpoints.c.status)
+            )
+        }
+    files_to_ingest = []
+    for log_file in log_files:
+        status = statuses.get(identities[log_file]["file_key"])
+        if status == IngestStatus.DONE:
+            logger.info(f"Skipping {log_file}; it was ingested before")
+            log_file.rename(log_parsed / log_file.name)
+        else:
+            files_to_ingest.append((log_file, status is None))
+
+    # Spawned rather than forked, as this process may already hold Polars' thread
+    # pool and database connections
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+
+        def submit(log_file: Path, parse: bool) -> tuple[Path, Future | None]:
+            if not parse:
+                return log_file, None
+            return log_file, executor.submit(parse_log_file, log_file)
+
+        # At most `workers` files are parsed, or parsed and waiting to be inserted, at
+        # a time, so memory doesn't grow with the number of files
+        files_to_submit = iter(files_to_ingest)
+        in_flight = deque(submit(*file) for file in islice(files_to_submit, workers))
+        while len(in_flight) > 0:
+            log_file, future = in_flight.popleft()
+            if future is None:
+                logger.info(f"Resuming the sequential ingest of {log_file}")
+                ingest_log_file(log_file)
+            else:
+                insert_parsed_log_file(
+                    log_file, identities[log_file], future.result(), mmdb_build
+                )
+            log_file.rename(log_parsed / log_file.name)
+            next_file = next(files_to_submit, None)
+            if next_file is not None:
+                in_flight.append(submit(*next_file))
+
+
+def insert_parsed_log_file(
+    log_file: Path,
+    identity: dict[str, Any],
+    parsed: tuple[pl.DataFrame, pl.DataFrame, int],
+    mmdb_build: int,
+):
+    """Insert the result of `parse_log_file` in one transaction; see `_main_parallel`"""
+    engine, tables = create_engine_table()
+    access_log = tables[TableNames.ACCESS_LOG]
+    pages_log = tables[TableNames.PAGES_LOG]
+    ip_geo_cache = tables[TableNames.IP_GEO_CACHE]
+    checkpoints = tables[TableNames.INGEST_CHECKPOINTS]
+    access_df, pages_df, offset = parsed
+    logger.info(f"Inserting rows parsed from {log_file}")
+    start_date, end_date = None, None
+    with engine.connect() as conn:
+        if len(access_df) > 0:
+            start_date, end_date = chunk_time_range(access_df)
+            stored = stored_request_ids(
+                conn, access_log, access_df["request_id"].to_list()
+            )
+            if len(stored) > 0 and len(pages_df) > 0:
+                pages_df = pages_df.filter(~pl.col("request_id").is_in(list(stored)))
+            insert_or_ignore_df(conn, access_log, access_df)
+        if len(pages_df) > 0:
+            insert_or_ignore_df(conn, pages_log, pages_df)
+            geo_df = pages_df.select(["addr", *GEO_INFO_COLUMNS]).unique()
+            update_geo_cache(conn, ip_geo_cache, geo_df, mmdb_build)
+            update_pages_rollup(conn, tables, *pages_time_range(pages_df))
+            if use_parquet_store():
+                write_pages_parquet(pages_df)
+        write_checkpoint(
+            conn,
+            checkpoints,
+            identity,
+            offset,
+            start_date,
+            end_date,
+            IngestStatus.DONE,
+        )
+        conn.commit()
+
+
+def _main(workers: int = 1):
     LOG_PATH = PROJECT_ROOT / "logs"
     LOG_PARSED = LOG_PATH / "parsed"
     LOG_PARSED.mkdir(exist_ok=True)
-    log_files = list(LOG_PATH.glob("*.log"))
+    log_files = [path for path in LOG_PATH.iterdir() if is_log_file(path)]
     log_files.sort()
     logger.info(f"Parsing {len(log_files)} log files.")
+    if workers > 1:
+        _main_parallel(log_files, LOG_PARSED, workers)
+        return
     for log_file in log_files:
         logger.info(f"Parsing log file with name {log_file}")
-        with open(log_file, "r") as log_file_stream:
-            start_date, end_date = ingest_access_log(log_file_stream)
+        ingest_log_file(log_file)
         log_file.rename(LOG_PARSED / log_file.name)
-        make_insert_pages(start_date, end_date)
+
+
+def parse_main_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes parsing log files in parallel. With more than one, "
+            "each file is committed whole, so a file interrupted during the run is "
+            "parsed again from its start"
+        ),
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    _main()
+    args = parse_main_args()
+    _main(workers=args.workers)
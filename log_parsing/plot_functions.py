@@ -1,7 +1,10 @@
 # %%
 import datetime
+import ipaddress
+import threading
+from collections import OrderedDict
 from enum import Enum
-from typing import Callable
+from typing import Any, Callable, Hashable
 
 import numpy as np
 import plotly.express as px
@@ -12,8 +15,13 @@ from scipy.ndimage import gaussian_filter1d
 
 from log_parsing.database_def import TableNames
 from log_parsing.config import logger
-from log_parsing.parse_access_log import load_df_from_db
+from log_parsing.query import scan_table
+from log_parsing.rollup import ROLLUP_MINUTES, rebuild_pages_rollup
 
+# Columns of `pages_log` used for filtering and plotting
+PLOT_COLUMNS = ["time", "local_time", "weekday", "page_name", "country", "continent"]
+# Low-cardinality string columns of `pages_log`, kept in memory as categoricals
+CATEGORICAL_COLUMNS = ["page_name", "timezone", "country", "country_iso", "continent"]
 IGNORED_PAGES = ["test", "users", "images"]
 IGNORE_PAGES_REGEX = r"^(" + "|".join(IGNORED_PAGES) + ")$"
 MARGINS = dict(margin_top=35, margin_bottom=20, margin_l=30, margin_r=0)
@@ -25,6 +33,105 @@ GO_MARGIN = go.layout.Margin(
 )
 
 
+def pack_addr(addr: str) -> bytes:
+    """IP address as 4 (IPv4) or 16 (IPv6) bytes; other strings are kept as is."""
+    try:
+        return ipaddress.ip_address(addr).packed
+    except ValueError:
+        return addr.encode()
+
+
+def encode_addr(addr: pl.Series) -> pl.Series:
+    unique_addr = addr.unique()
+    packed = pl.Series("_packed", [pack_addr(a) for a in unique_addr], pl.Binary)
+    mapping = pl.DataFrame([unique_addr, packed])
+    return addr.to_frame().join(mapping, on=addr.name, how="left")["_packed"]
+
+
+def slice_time_range(
+    df: pl.DataFrame,
+    date_start: datetime.datetime | None = None,
+    date_end: datetime.datetime | None = None,
+) -> pl.DataFrame:
+    """
+    The rows of `df` with a time from date_start up to but not including date_end,
+    found by binary search on the sorted `time` column. The end is exclusive since the
+    rows of the rollup stand for the hour starting at their time.
+    """
+    time = df["time"]
+    start_index = 0
+    end_index = len(df)
+    if date_start is not None:
+        bound = pl.Series([date_start]).cast(time.dtype)
+        start_index = time.search_sorted(bound, side="left")[0]
+    if date_end is not None:
+        bound = pl.Series([date_end]).cast(time.dtype)
+        end_index = time.search_sorted(bound, side="left")[0]
+    return df[start_index : max(start_index, end_index)]
+
+
+def compact_pages_df(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Encode the columns of a `pages_log` frame compactly for keeping it in memory.
+    String columns in `CATEGORICAL_COLUMNS` become categoricals in the global string
+    cache, sorted lexically like the strings; `request_id` is decoded from hex and
+    `addr` is packed into bytes.
+    """
+    pl.enable_string_cache(True)
+    columns = []
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS:
+            columns.append(
+                pl.col(column).cast(pl.Categorical).cat.set_ordering("lexical")
+            )
+        elif column == "request_id":
+            columns.append(pl.col(column).str.decode("hex"))
+        elif column == "addr":
+            columns.append(pl.lit(encode_addr(df[column])).alias(column))
+        elif column == "weekday":
+            columns.append(pl.col(column).cast(pl.Int8))
+    return df.with_columns(columns)
+
+
+def load_pages_df(columns: list[str] | None = PLOT_COLUMNS) -> pl.DataFrame:
+    """
+    Load `pages_log` for plotting, sorted by time and with the columns encoded by
+    `compact_pages_df`
+    """
+    df = scan_table(TableNames.PAGES_LOG, columns=columns).collect().sort("time")
+    size_before = df.estimated_size("mb")
+    df = compact_pages_df(df)
+    logger.info(
+        f"Loaded {len(df)} pages using {df.estimated_size('mb'):.2f} MB "
+        f"({size_before:.2f} MB before encoding)"
+    )
+    return df
+
+
+def load_rollup_df(
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+) -> pl.DataFrame:
+    """
+    Load the rows of `pages_rollup` in between start_date and end_date (all by
+    default) for plotting, sorted by time and with the columns encoded by
+    `compact_pages_df`
+    """
+    df = scan_table(
+        TableNames.PAGES_ROLLUP, start_date=start_date, end_date=end_date
+    ).collect()
+    if len(df) == 0 and start_date is None and end_date is None:
+        # Database made before the rollup existed
+        rebuild_pages_rollup()
+        df = scan_table(TableNames.PAGES_ROLLUP).collect()
+    df = compact_pages_df(df.sort("time"))
+    logger.info(
+        f"Loaded rollup of {df['count'].sum()} pages in {len(df)} rows using "
+        f"{df.estimated_size('mb'):.2f} MB"
+    )
+    return df
+
+
 class FilterModel(BaseModel):
     dateRange: tuple[datetime.datetime | None, datetime.datetime | None]
     countries: list[str] | None
@@ -58,6 +165,14 @@ class FilterModel(BaseModel):
         """Index is packet as list[str], but we just want a single int"""
         return int(v[0])
 
+    def normalized(self) -> dict:
+        """The filter as a dict, with the same value for filters selecting the same"""
+        data = self.dict()
+        for key in ["countries", "continents", "pageNames"]:
+            if data[key] is not None:
+                data[key] = sorted(set(data[key]))
+        return data
+
     def to_filtered_data_frame(self, df: pl.DataFrame, colors: list[str] | None = None):
         if colors is None:
             colors = px.colors.qualitative.T10
@@ -74,6 +189,48 @@ class FilterModel(BaseModel):
         )
 
 
+class MemoCache:
+    """
+    Least recently used cache of at most `max_size` computed values, counting its
+    hits and misses.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Filtered frames and the aggregates computed from them, shared between plots and
+# requests. The keys contain `id` of the unfiltered frame, which is kept alive by
+# the cached values so the id can't be reused by another frame.
+filtered_frame_cache = MemoCache(max_size=32)
+aggregate_cache = MemoCache(max_size=1024)
+
+
 class FilteredDataFrame:
     def __init__(
         self,
@@ -96,26 +253,53 @@ class FilteredDataFrame:
         self.page_names = page_names
         self.plot_color = plot_color
 
-        self.dataframe = self._filter_df(df)
+        self._source_df = df
+        self._cache_key = (id(df), self.filter_key)
+        self.dataframe = filtered_frame_cache.get_or_compute(
+            self._cache_key, lambda: (df, self._filter_df(df))
+        )[1]
 
-    def _get_filter_predicate(self) -> pl.Expr | None:
+    @property
+    def filter_key(self) -> tuple:
+        """The filters, with the same value for filters selecting the same rows"""
+        return (
+            self.date_start,
+            self.date_end,
+            *[
+                tuple(sorted(set(values))) if values is not None else None
+                for values in [self.countries, self.continents, self.page_names]
+            ],
+        )
+
+    def aggregate(self, function: Callable[..., Any], *args: Hashable) -> Any:
+        """
+        Return `function(self.dataframe, *args)`, computed once for all filters
+        selecting the same rows of the same frame.
+        """
+        source_df = self._source_df
+        return aggregate_cache.get_or_compute(
+            (*self._cache_key, function, args),
+            lambda: (source_df, function(self.dataframe, *args)),
+        )[1]
+
+    def _get_filter_predicate(self, time_sorted: bool = False) -> pl.Expr | None:
+        """
+        Predicate for the filters. The date range is left out if `time_sorted`, since
+        it is then applied by `slice_time_range`.
+        """
         selectors = []
-        if self.date_start is not None and self.date_end is not None:
-            selectors.append(pl.col("time").is_between(self.date_start, self.date_end))
-        elif self.date_start is not None and self.date_end is None:
-            selectors.append(pl.col("time") >= self.date_start)
-        elif self.date_start is None and self.date_end is not None:
-            selectors.append(pl.col("time") <= self.date_end)
+        time = pl.col("time")
+        if not time_sorted and self.date_start is not None:
+            selectors.append(time >= self.date_start)
+        if not time_sorted and self.date_end is not None:
+            selectors.append(time < self.date_end)
 
         if self.countries is not None:
-            countries_regex = "|".join(self.countries)
-            selectors.append(pl.col("country").str.contains(countries_regex))
+            selectors.append(pl.col("country").is_in(self.countries))
         if self.continents is not None:
-            continents_regex = "|".join(self.continents)
-            selectors.append(pl.col("continent").str.contains(continents_regex))
+            selectors.append(pl.col("continent").is_in(self.continents))
         if self.page_names is not None:
-            page_names_regex = "|".join(self.page_names)
-            selectors.append(pl.col("page_name").str.contains(page_names_regex))
+            selectors.append(pl.col("page_name").is_in(self.page_names))
         if len(selectors) == 0:
             return None
 
@@ -147,6 +331,11 @@ class FilteredDataFrame:
                 labels.append(f"Pages=[{page_names_string}]")
         return labels
 
+    @property
+    def num_pages(self) -> int:
+        """Number of pages matching the filters"""
+        return self.aggregate(count_pages)
+
     @property
     def plot_number(self) -> str:
         return str(self.index + 1)
@@ -163,7 +352,10 @@ class FilteredDataFrame:
         self,
         df: pl.DataFrame,
     ) -> pl.DataFrame:
-        filter_predicate = self._get_filter_predicate()
+        time_sorted = df["time"].flags["SORTED_ASC"]
+        if time_sorted:
+            df = slice_time_range(df, self.date_start, self.date_end)
+        filter_predicate = self._get_filter_predicate(time_sorted)
         if filter_predicate is None:
             return df
         return df.filter(filter_predicate)
@@ -184,9 +376,20 @@ class FilteredDataFrame:
         return repr_str
 
 
+def count_pages(df: pl.DataFrame) -> int:
+    if "count" in df.columns:
+        return int(df["count"].sum())
+    return len(df)
+
+
+def sum_counts(rollup_df: pl.DataFrame, by: str | pl.Expr) -> pl.DataFrame:
+    """Number of pages for each value of `by`, like `value_counts` of the pages"""
+    return rollup_df.groupby(by).agg(pl.col("count").sum().alias("counts"))
+
+
 def compute_date_hour_count(df: pl.DataFrame, frequency="1h") -> pl.DataFrame:
-    date_hour = df["time"].dt.truncate(frequency)
-    date_hour_count = date_hour.value_counts().sort(by="time")
+    date_hour_count = sum_counts(df, pl.col("time").dt.truncate(frequency))
+    date_hour_count = date_hour_count.sort(by="time")
     min_date = date_hour_count["time"].min()
     max_date = date_hour_count["time"].max()
     date_range = pl.date_range(
@@ -199,22 +402,18 @@ def compute_date_hour_count(df: pl.DataFrame, frequency="1h") -> pl.DataFrame:
     return date_hour_count
 
 
-def get_hour_minute_count(
-    df: pl.DataFrame, time_res_minutes: int, column="time"
-) -> pl.DataFrame:
-    h_m = df.select(
-        (
-            (
-                pl.col(column).dt.hour() * 3600
-                + pl.col(column).dt.truncate(f"{time_res_minutes}m").dt.minute() * 60
-            )
-            * 1e9
+def get_hour_minute_count(df: pl.DataFrame, time_res_minutes: int) -> pl.DataFrame:
+    """
+    Number of pages per interval of the local time of day. The rollup counts pages
+    per `ROLLUP_MINUTES`, so `time_res_minutes` has to be a multiple of it.
+    """
+    if time_res_minutes % ROLLUP_MINUTES != 0:
+        raise ValueError(
+            f"Time resolution has to be a multiple of {ROLLUP_MINUTES} minutes"
         )
-        .cast(pl.Time)
-        .alias("hour_minute")
-    )
-
-    h_m_count = h_m["hour_minute"].value_counts().sort("hour_minute")
+    minute = pl.col("local_minute") // time_res_minutes * time_res_minutes
+    hour_minute = (minute * 60 * 1e9).cast(pl.Time).alias("hour_minute")
+    h_m_count = sum_counts(df, hour_minute).sort("hour_minute")
     all_times_series = pl.Series(
         np.arange(24 * 60 // time_res_minutes) * time_res_minutes * 60 * 1e9
     ).cast(pl.Time)
@@ -242,7 +441,7 @@ def make_filter_map(
 def make_hour_minute_plot_data(df: pl.DataFrame) -> pl.DataFrame:
     x_label = "Time of day"
     y_label = "relative frequency"
-    hour_minute = get_hour_minute_count(df, 10, "local_time")
+    hour_minute = get_hour_minute_count(df, 10)
     hour_minute = hour_minute.with_columns(
         pl.col("hour_minute").dt.strftime("%H:%M").alias(x_label),
         (
@@ -263,7 +462,7 @@ def make_line_plot(
     layout_kwargs: dict | None = None,
     title: str | None = None,
 ) -> go.Figure:
-    plot_dfs = [plot_data_function(df.dataframe) for df in filter_dfs]
+    plot_dfs = [df.aggregate(plot_data_function) for df in filter_dfs]
     fig = go.Figure()
     for filter, plot_df in zip(filter_dfs, plot_dfs):
         fig.add_trace(
@@ -307,13 +506,17 @@ def get_rolling_mean_1w(df: pl.DataFrame) -> pl.DataFrame:
         .fill_null(0)
         .map(make_filter_map(20, GaussianFilterMode.WRAP))
         .alias(y_label)
-        / len(df),
+        / df["count"].sum(),
     )
     return rolling_sum
 
 
 def make_weekday_plot_data(df: pl.DataFrame) -> pl.DataFrame:
-    weekday_df = df["weekday"].value_counts().sort(by="weekday")
+    weekday_df = (
+        sum_counts(df, "weekday")
+        .with_columns(pl.col("weekday").cast(pl.Int64))
+        .sort(by="weekday")
+    )
 
     if len(weekday_df) < 7:
         weekday_all = pl.DataFrame({"weekday": np.arange(7) + 1})
@@ -328,7 +531,7 @@ def make_weekday_plot_data(df: pl.DataFrame) -> pl.DataFrame:
 
 
 def make_weekday_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figure:
-    weekday_dfs = [make_weekday_plot_data(df.dataframe) for df in filtered_dfs]
+    weekday_dfs = [df.aggregate(make_weekday_plot_data) for df in filtered_dfs]
     x_label = "weekday"
     y_label = "Fraction"
     fig = go.Figure()
@@ -351,8 +554,8 @@ def make_weekday_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figure:
 
 def make_page_popularity_plot_data(df: pl.DataFrame) -> pl.DataFrame:
     df_bar = (
-        df["page_name"]
-        .value_counts()
+        sum_counts(df, "page_name")
+        .with_columns(pl.col("page_name").cast(pl.Utf8))
         .sort(by="page_name")
         .filter(pl.col("page_name").str.contains(IGNORE_PAGES_REGEX).is_not())
         .with_columns((pl.col("counts") / pl.col("counts").sum()))
@@ -369,7 +572,7 @@ def make_page_popularity_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figur
     fig = go.Figure()
     all_labels: set[str] = set()
     for filter in filtered_dfs:
-        df_bar = make_page_popularity_plot_data(filter.dataframe)
+        df_bar = filter.aggregate(make_page_popularity_plot_data)
         all_labels.update(df_bar[x_label])
         fig.add_trace(
             go.Bar(
@@ -405,9 +608,9 @@ def make_country_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figure:
     plot_labels = [fdf.plot_number for fdf in filtered_dfs]
     x_label = "Country"
     val_counts = [
-        fdf.dataframe["country"]
-        .alias(x_label)
-        .value_counts()
+        fdf.aggregate(sum_counts, "country")
+        .rename({"country": x_label})
+        .with_columns(pl.col(x_label).cast(pl.Utf8))
         .sort(by=x_label)
         .with_columns(pl.col("counts").cast(pl.Float32) / pl.col("counts").sum())
         .rename({"counts": fdf.plot_number})
@@ -452,7 +655,11 @@ def make_country_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figure:
 
 
 def make_continent_plot_data(df: pl.DataFrame) -> pl.DataFrame:
-    plot_df = df["continent"].value_counts().sort(by="continent")
+    plot_df = (
+        sum_counts(df, "continent")
+        .with_columns(pl.col("continent").cast(pl.Utf8))
+        .sort(by="continent")
+    )
     plot_df = plot_df.with_columns(
         (pl.col("counts") / pl.col("counts").sum()).alias("Fraction"),
     )
@@ -460,7 +667,7 @@ def make_continent_plot_data(df: pl.DataFrame) -> pl.DataFrame:
 
 
 def make_continent_plot(filtered_dfs: list[FilteredDataFrame]) -> go.Figure:
-    plot_df_list = [make_continent_plot_data(df.dataframe) for df in filtered_dfs]
+    plot_df_list = [df.aggregate(make_continent_plot_data) for df in filtered_dfs]
     x_label = "continent"
     y_label = "Fraction"
     fig = go.Figure()
@@ -544,7 +751,7 @@ plot_functions = {name: modify_layout(func) for name, func in plot_functions.ite
 
 
 if __name__ == "__main__":
-    df = load_df_from_db(TableNames.PAGES_LOG)
+    df = load_rollup_df()
     date_start = df["time"][0]
     date_end = df["time"][-1]
     filtered_dfs = [
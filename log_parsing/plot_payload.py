@@ -0,0 +1,59 @@
+# %%
+"""
+Compact JSON encoding of the dashboard plots.
+
+Numeric arrays are encoded as base64 typed arrays, `{"dtype": "f4", "bdata": ...}`,
+and the layout template, which is the same for every figure, is left out. The
+frontend gets the template once from `/plot-template` and decodes the arrays.
+"""
+
+import base64
+from typing import Any
+
+import numpy as np
+import orjson
+import plotly.graph_objects as go
+
+INT32_MIN = np.iinfo(np.int32).min
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def dumps(data: Any) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def encode_array(values: np.ndarray) -> Any:
+    """Numeric arrays as little-endian float32 or int32, the others as lists"""
+    if values.dtype.kind == "f":
+        dtype = "f4"
+    elif values.dtype.kind in "iu" and len(values) > 0:
+        fits_int32 = INT32_MIN <= values.min() and values.max() <= INT32_MAX
+        dtype = "i4" if fits_int32 else "f8"
+    elif values.dtype.kind == "M":
+        return np.datetime_as_string(values, unit="s").tolist()
+    else:
+        return values.tolist()
+    bdata = values.astype(np.dtype(dtype).newbyteorder("<")).tobytes()
+    return {"dtype": dtype, "bdata": base64.b64encode(bdata).decode()}
+
+
+def encode_arrays(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return encode_array(value)
+    if isinstance(value, dict):
+        return {key: encode_arrays(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_arrays(item) for item in value]
+    return value
+
+
+def compact_figure(fig: go.Figure) -> dict:
+    """The figure as a dict with encoded arrays and without layout template"""
+    figure = fig.to_plotly_json()
+    figure["layout"].pop("template", None)
+    return encode_arrays(figure)
+
+
+def plot_template() -> dict:
+    """The layout template left out by `compact_figure`"""
+    return go.Figure().layout.template.to_plotly_json()
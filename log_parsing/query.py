@@ -0,0 +1,63 @@
+# %%
+"""
+Lazy queries over the tables in `TableNames`. Column selections and filters are
+pushed down into SQLite, or into the Parquet store for `pages_log`.
+"""
+
+import datetime
+from typing import Any
+
+import polars as pl
+from sqlalchemy import select
+
+from log_parsing.database_def import (
+    TIME_COLUMNS,
+    TableNames,
+    create_engine_table,
+    read_sql_select,
+)
+from log_parsing.parquet_store import scan_pages_parquet, use_parquet_store
+
+
+def scan_table(
+    table_name: TableNames,
+    columns: list[str] | None = None,
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+    filters: dict[str, Any] | None = None,
+) -> pl.LazyFrame:
+    """
+    Query a table, keeping only `columns` (all by default) and the rows with a time
+    in between start_date and end_date.
+
+    `filters` maps column names to a value the column should be equal to, or to a
+    list of values it should be one of.
+    """
+    _, tables = create_engine_table()
+    table = tables[table_name]
+    if columns is None:
+        columns = list(table.columns.keys())
+    for column in [*columns, *(filters or {})]:
+        if column not in table.columns:
+            raise ValueError(f"Table {table.name} has no column {column}")
+
+    if table_name == TableNames.PAGES_LOG and use_parquet_store():
+        pages = scan_pages_parquet(start_date=start_date, end_date=end_date)
+        for column, value in (filters or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                pages = pages.filter(pl.col(column).is_in(list(value)))
+            else:
+                pages = pages.filter(pl.col(column) == value)
+        return pages.select(columns)
+
+    stmt = select(*[table.c[column] for column in columns])
+    if start_date is not None:
+        stmt = stmt.where(table.c[TIME_COLUMNS[table_name]] >= start_date)
+    if end_date is not None:
+        stmt = stmt.where(table.c[TIME_COLUMNS[table_name]] <= end_date)
+    for column, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            stmt = stmt.where(table.c[column].in_(list(value)))
+        else:
+            stmt = stmt.where(table.c[column] == value)
+    return read_sql_select(stmt).lazy()
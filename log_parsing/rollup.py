@@ -0,0 +1,103 @@
+# %%
+"""
+Pre-aggregated page counts for the dashboard, kept in the `pages_rollup` table.
+
+The plots only need the number of pages per hour, weekday, page, country, continent
+and 10 minute interval of the local time of day. Counting them once when the pages
+are inserted makes the dashboard independent of the number of requests.
+"""
+
+import datetime
+
+from sqlalchemy import Connection, Integer, Table, cast, func, select
+
+from log_parsing.config import logger
+from log_parsing.database_def import TableNames, create_engine_table
+
+ROLLUP_MINUTES = 10
+# Columns of `pages_log` that are copied into `pages_rollup` as they are
+ROLLUP_DIMENSIONS = ["weekday", "page_name", "country", "continent"]
+
+
+def truncate_hour(time: datetime.datetime) -> datetime.datetime:
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_select(
+    pages_log: Table,
+    start_hour: datetime.datetime | None = None,
+    end_hour: datetime.datetime | None = None,
+):
+    """Select the rows of `pages_rollup` for the pages in the hours start to end"""
+    hour = func.strftime("%Y-%m-%d %H:00:00.000000", pages_log.c.time)
+    local_time = pages_log.c.local_time
+    local_minute = (
+        cast(func.strftime("%H", local_time), Integer) * 60
+        + cast(func.strftime("%M", local_time), Integer)
+        // ROLLUP_MINUTES
+        * ROLLUP_MINUTES
+    )
+    dimensions = [
+        hour.label("time"),
+        *[pages_log.c[column] for column in ROLLUP_DIMENSIONS],
+        local_minute.label("local_minute"),
+    ]
+    stmt = select(*dimensions, func.count().label("count"))
+    if start_hour is not None:
+        stmt = stmt.where(pages_log.c.time >= start_hour)
+    if end_hour is not None:
+        stmt = stmt.where(pages_log.c.time < end_hour + datetime.timedelta(hours=1))
+    return stmt.group_by(*dimensions)
+
+
+def update_pages_rollup(
+    conn: Connection,
+    tables: dict[TableNames, Table],
+    start_date: datetime.datetime | None = None,
+    end_date: datetime.datetime | None = None,
+):
+    """
+    Recount the hours from start_date to end_date in `pages_rollup` from the rows of
+    `pages_log`; all hours if a date is missing or if the rollup is still empty.
+
+    The recounted hours are recorded in `rollup_updates`, so readers of the rollup
+    can reload just those.
+    """
+    pages_log = tables[TableNames.PAGES_LOG]
+    pages_rollup = tables[TableNames.PAGES_ROLLUP]
+    rollup_updates = tables[TableNames.ROLLUP_UPDATES]
+    if conn.execute(select(pages_rollup.c.time).limit(1)).first() is None:
+        start_date = end_date = None
+    start_hour = truncate_hour(start_date) if start_date is not None else None
+    end_hour = truncate_hour(end_date) if end_date is not None else None
+
+    delete_stmt = pages_rollup.delete()
+    if start_hour is not None:
+        delete_stmt = delete_stmt.where(pages_rollup.c.time >= start_hour)
+    if end_hour is not None:
+        delete_stmt = delete_stmt.where(pages_rollup.c.time <= end_hour)
+    conn.execute(delete_stmt)
+
+    stmt = rollup_select(pages_log, start_hour, end_hour)
+    result = conn.execute(
+        pages_rollup.insert().from_select(stmt.selected_columns.keys(), stmt)
+    )
+    conn.execute(
+        rollup_updates.insert().values(start_hour=start_hour, end_hour=end_hour)
+    )
+    logger.info(
+        f"Updated {result.rowcount} rows of the pages rollup from {start_hour} to "
+        f"{end_hour}"
+    )
+
+
+def rebuild_pages_rollup():
+    """Recount all of `pages_rollup`"""
+    engine, tables = create_engine_table()
+    with engine.connect() as conn:
+        update_pages_rollup(conn, tables)
+        conn.commit()
+
+
+if __name__ == "__main__":
+    rebuild_pages_rollup()
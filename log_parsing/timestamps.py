@@ -0,0 +1,66 @@
+# %%
+"""
+Parsing of the `time_iso8601` timestamps written by nginx, which always have the
+form `2023-04-05T22:59:16+02:00`. The results are the same as those of
+`dateutil.parser.isoparse`, which is used for any other form.
+"""
+
+import datetime
+from functools import lru_cache
+
+import dateutil.parser
+import polars as pl
+
+ISO8601_OFFSET_REGEX = r"(Z|[+-]\d{2}:?\d{2})$"
+# Sign, hours and minutes of the offset; doesn't match `Z`
+UTC_OFFSET_REGEX = r"([+-])(\d{2}):?(\d{2})$"
+NGINX_TIME_LENGTH = len("2023-04-05T22:59:16+02:00")
+
+
+@lru_cache(maxsize=64)
+def parse_utc_offset(offset: str) -> datetime.tzinfo | None:
+    """The tzinfo `isoparse` gives for the offset, e.g. `tzutc()` for +00:00"""
+    return dateutil.parser.isoparse("2000-01-01T00:00:00" + offset).tzinfo
+
+
+# Consecutive lines of the log mostly have the same timestamp, so most calls are hits
+@lru_cache(maxsize=1024)
+def parse_nginx_time(time_str: str) -> datetime.datetime:
+    """Parse a timestamp like `dateutil.parser.isoparse`, fast for the nginx form"""
+    if (
+        len(time_str) != NGINX_TIME_LENGTH
+        or time_str[10] != "T"
+        or time_str[19] not in "+-"
+        or time_str[22] != ":"
+    ):
+        return dateutil.parser.isoparse(time_str)
+    return datetime.datetime.fromisoformat(time_str[:19]).replace(
+        tzinfo=parse_utc_offset(time_str[19:])
+    )
+
+
+def nginx_time_utc(time_str: pl.Expr) -> pl.Expr:
+    """
+    The instant of the timestamps in UTC. The offset is applied per row, as a chunk
+    of the log can span a change to or from daylight saving time.
+    """
+    offset_sign = (
+        pl.when(time_str.str.extract(UTC_OFFSET_REGEX, 1) == "-").then(-1).otherwise(1)
+    )
+    offset_minutes = offset_sign * (
+        time_str.str.extract(UTC_OFFSET_REGEX, 2).cast(pl.Int64) * 60
+        + time_str.str.extract(UTC_OFFSET_REGEX, 3).cast(pl.Int64)
+    ).fill_null(0)
+    return (
+        nginx_time_local(time_str) - pl.duration(minutes=offset_minutes)
+    ).dt.replace_time_zone("UTC")
+
+
+def nginx_time_local(time_str: pl.Expr) -> pl.Expr:
+    """
+    The wall-clock time of the timestamps in their own offset, without time zone, as
+    stored by SQLAlchemy for the datetimes of `parse_nginx_time`
+    """
+    return time_str.str.replace(ISO8601_OFFSET_REGEX, "").str.strptime(
+        pl.Datetime("us"), "%Y-%m-%dT%H:%M:%S"
+    )
@@ -0,0 +1,10 @@
+# %%
+"""
+Run follow_log.py
+"""
+
+from log_parsing.follow_log import follow_log, parse_follow_args
+
+if __name__ == "__main__":
+    args = parse_follow_args()
+    follow_log(args.log_path, args.batch_size, args.flush_interval, args.poll_interval)
@@ -1,10 +1,18 @@
+from log_parsing.log_files import open_log_file
 from log_parsing.parse_access_log import parse_ingest_file
+from pathlib import Path
 import argparse
+import io
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("file", type=str)
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Parse the log in chunks with Polars instead of line by line",
+    )
     args = parser.parse_args()
-    with open(args.file) as f:
-        parse_ingest_file(f)
+    with io.TextIOWrapper(open_log_file(Path(args.file))) as f:
+        parse_ingest_file(f, columnar=args.columnar)
@@ -3,7 +3,8 @@
 Run parse_access_log.py
 """
 
-from log_parsing.parse_access_log import _main
+from log_parsing.parse_access_log import _main, parse_main_args
 
 if __name__ == "__main__":
-    _main()
+    args = parse_main_args()
+    _main(workers=args.workers)
@@ -8,7 +8,7 @@ import json
 from datetime import timedelta, datetime
 from zoneinfo import ZoneInfo
 from log_parsing.config import PROJECT_ROOT
-import dateutil.parser
+from log_parsing.timestamps import parse_nginx_time
 
 LOG_DIR = PROJECT_ROOT / "logs"
 LOG_DIR.mkdir(exist_ok=True)
@@ -21,7 +21,7 @@ with open(ACCES_LOG_FILE, "r") as f:
     weeknum = 0
     for i, line in enumerate(f):
         data = json.loads(line)
-        time = dateutil.parser.isoparse(data["time_iso8601"])
+        time = parse_nginx_time(data["time_iso8601"])
         if time - start_time > timedelta(days=7):
             start_time = time
             write_file.close()